@@ -0,0 +1,742 @@
+__doc__ = """
+Benchmarks and consistency checks for the image segmentation pipeline.
+Run one of them like so:
+
+    python benchmarks.py NAME
+
+where NAME is one of the keys of BENCHMARKS below.
+
+"""
+
+import base64
+import io
+import json
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import threading
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from time import sleep, time
+import numpy as np
+from scipy import ndimage as ndi
+import skimage.io
+import skimage.filters
+import plotly.express as px
+import forest_utils
+import image_segmentation
+import job_utils
+import shape_utils
+import shapes_to_segmentations
+import use_ml_image_segmentation_classifier
+
+EXAMPLE_IMAGE_PATH = "assets/segmentation_img.jpg"
+EXAMPLE_SHAPES_PATH = "assets/segmentation_img_labels.json"
+
+
+def load_example():
+    img = skimage.io.imread(EXAMPLE_IMAGE_PATH)
+    with open(EXAMPLE_SHAPES_PATH) as fd:
+        shapes = json.load(fd)
+    return img, shapes
+
+
+def load_example_mask():
+    """
+    The example image and the mask of its strokes, labelled 1, 2 and 3 in
+    turn
+    """
+    img, shapes = load_example()
+    height, width = img.shape[:2]
+    mask = shape_utils.shapes_to_mask(
+        [dict(shape=s, width=width, height=height) for s in shapes],
+        [n % 3 + 1 for n in range(len(shapes))],
+    )
+    return img, mask
+
+
+def timeit(f, *args, repeat=3, **kwargs):
+    """Returns the result of f(*args, **kwargs) and its best time of repeat runs"""
+    best = None
+    for _ in range(repeat):
+        t = time()
+        r = f(*args, **kwargs)
+        dt = time() - t
+        best = dt if best is None else min(best, dt)
+    return r, best
+
+
+# Bounds on the differences of the masks of shape_to_mask and CairoSVG, which
+# only differ by the antialiased edge pixels that cairo's sampling misses:
+# the smallest IoU of the mask of a shape (measured at 0.970 for a 1 pixel
+# wide line and at least 0.988 for the others), and the largest fraction of
+# the pixels on the edges of the strokes of the example mask whose labels
+# differ (measured at 0.010).
+MIN_RASTERIZER_IOU = 0.96
+MAX_EDGE_DISAGREEMENT = 0.02
+
+
+def rasterizer_fidelity():
+    """
+    Compares shape_utils.shape_to_mask with the masks rendered by CairoSVG
+    for the example strokes, plus some rects and closed paths, and checks
+    that their IoU is at least MIN_RASTERIZER_IOU, and that the labels of
+    the example mask differ on at most MAX_EDGE_DISAGREEMENT of the pixels
+    on the edges of the strokes. Skipped if CairoSVG or the cairo library is
+    missing.
+    """
+    try:
+        import cairosvg
+    except (ImportError, OSError) as e:
+        print("skipped, CairoSVG is unavailable: %s" % (str(e).splitlines()[0],))
+        return
+    img, shapes = load_example()
+    height, width = img.shape[:2]
+    shape_args = [dict(shape=s, width=width, height=height) for s in shapes]
+    layers = [n % 3 + 1 for n in range(len(shapes))]
+    labels = {
+        method: shape_utils.shapes_to_mask(shape_args, layers, method=method)
+        for method in ["native", "cairo"]
+    }
+    # pixels within a pixel of a change of the labels of either mask
+    edges = np.zeros(labels["cairo"].shape, dtype=bool)
+    for mask in labels.values():
+        edges |= ndi.grey_dilation(mask, size=3) != ndi.grey_erosion(mask, size=3)
+    differ = labels["native"] != labels["cairo"]
+    labelled = (labels["native"] > 0) | (labels["cairo"] > 0)
+    print(
+        "labels differ on %.4f of the labelled pixels, %.4f of the edge pixels"
+        % (differ[labelled].mean(), differ[edges].mean())
+    )
+    assert differ[edges].mean() <= MAX_EDGE_DISAGREEMENT
+    line = {"color": "#000000", "width": 3}
+    shapes = shapes + [
+        {"type": "rect", "x0": 100.3, "y0": 50, "x1": 400, "y1": 321.7, "line": line},
+        {"type": "path", "path": "M500,500L700,520L610,700Z", "line": line},
+        {"type": "path", "path": "M30.5,900L1200,880", "line": dict(line, width=1)},
+    ]
+    print("shape\tnative px\tcairo px\tIoU\tnative s\tcairo s")
+    for n, shape in enumerate(shapes):
+        native, t_native = timeit(
+            shape_utils.shape_to_mask, shape, width=width, height=height
+        )
+        if shape["type"] == "rect":
+            # CairoSVG is given the rect as a closed path
+            x0, y0, x1, y1 = [shape[k] for k in ["x0", "y0", "x1", "y1"]]
+            path = "M%s,%sL%s,%sL%s,%sL%s,%sZ" % (x0, y0, x1, y0, x1, y1, x0, y1)
+            shape = dict(shape, type="path", path=path)
+        cairo, t_cairo = timeit(
+            shape_utils.shape_to_mask_cairo, shape, width=width, height=height
+        )
+        iou = (native & cairo).sum() / max((native | cairo).sum(), 1)
+        print(
+            "%d\t%d\t%d\t%.4f\t%.4f\t%.4f"
+            % (n, native.sum(), cairo.sum(), iou, t_native, t_cairo)
+        )
+        assert iou >= MIN_RASTERIZER_IOU, "shape %d: IoU %.4f" % (n, iou)
+
+
+def _label_to_colors_loop(
+    img, colormap=px.colors.qualitative.Light24, alpha=128, color_class_offset=0
+):
+    """The per-class implementation label_to_colors had before the palette lookup"""
+    fromhex = shapes_to_segmentations.fromhex
+    colormap = [
+        tuple([fromhex(h[s : s + 2]) for s in range(0, len(h), 2)])
+        for h in [c.replace("#", "") for c in colormap]
+    ]
+    cimg = np.zeros(img.shape[:2] + (3,), dtype="uint8")
+    minc = np.min(img)
+    maxc = np.max(img)
+    for c in range(minc, maxc + 1):
+        cimg[img == c] = colormap[(c + color_class_offset) % len(colormap)]
+    return np.concatenate(
+        (cimg, alpha * np.ones(img.shape[:2] + (1,), dtype="uint8")), axis=2
+    )
+
+
+def label_to_colors_lut(height=2160, width=3840, n_classes=24):
+    """
+    Times label_to_colors against the per-class loop it replaced on a 4K label
+    image with 24 classes.
+    """
+    rng = np.random.RandomState(0)
+    labels = rng.randint(0, n_classes, size=(height, width)).astype("uint8")
+    args = dict(colormap=px.colors.qualitative.Light24, color_class_offset=-1)
+    ref, t_loop = timeit(_label_to_colors_loop, labels, **args)
+    lut, t_lut = timeit(shapes_to_segmentations.label_to_colors, labels, **args)
+    out = np.empty_like(lut)
+    _, t_out = timeit(shapes_to_segmentations.label_to_colors, labels, out=out, **args)
+    wide, t_wide = timeit(
+        shapes_to_segmentations.label_to_colors, labels.astype(int), **args
+    )
+    assert np.array_equal(ref, lut) and np.array_equal(ref, wide)
+    print("loop\t%.4f s" % (t_loop,))
+    print("lut\t%.4f s (%.1fx)" % (t_lut, t_loop / t_lut))
+    print("lut out=\t%.4f s (%.1fx)" % (t_out, t_loop / t_out))
+    print("int64 labels\t%.4f s (%.1fx)" % (t_wide, t_loop / t_wide))
+
+
+# Bounds on the errors of the features of the approximate scale spaces against
+# "direct", relative to the range of each feature: the largest error more
+# than feature_halo(sigma_max) pixels from the image borders (the blurs
+# handle the borders differently) and the largest mean error of a feature.
+# Measured on the example image: cascade 0.035 and 0.0027, octave 0.154 and
+# 0.0079.
+SCALE_SPACE_MAX_ERRORS = {"cascade": (0.05, 0.005), "octave": (0.2, 0.01)}
+
+
+def scale_spaces():
+    """
+    Times computing the features of the example image with the "cascade" and
+    "octave" scale spaces against "direct", and checks that their errors are
+    within SCALE_SPACE_MAX_ERRORS.
+    """
+    img, _ = load_example()
+    ref, t_direct = timeit(image_segmentation.compute_features, img, repeat=1)
+    span = ref.max(axis=(1, 2)) - ref.min(axis=(1, 2))
+    halo = image_segmentation.feature_halo(16)
+    inner = (slice(None), slice(halo, -halo), slice(halo, -halo))
+    print("scale space\ttime s\tspeedup\tmax inner error\tmax mean error")
+    print("direct\t%.2f\t1\t0\t0" % (t_direct,))
+    for scale_space, (max_inner, max_mean) in SCALE_SPACE_MAX_ERRORS.items():
+        features, t = timeit(
+            image_segmentation.compute_features,
+            img,
+            scale_space=scale_space,
+            repeat=1,
+        )
+        err = np.abs(features - ref)
+        inner_err = (err[inner].max(axis=(1, 2)) / span).max()
+        mean_err = (err.mean(axis=(1, 2)) / span).max()
+        print(
+            "%s\t%.2f\t%.2fx\t%.4f\t%.4f"
+            % (scale_space, t, t_direct / t, inner_err, mean_err)
+        )
+        assert inner_err <= max_inner and mean_err <= max_mean
+
+
+def blur_backends(sigmas=(1, 2, 4, 8, 16, 20)):
+    """
+    Time and error against skimage.filters.gaussian of the blur backends of
+    image_segmentation.gaussian_blur, for a channel of the example image and
+    for uniform noise, across sigmas. Below
+    image_segmentation.APPROXIMATE_BLUR_MIN_SIGMA, all backends are exact.
+    """
+    img, _ = load_example()
+    images = {
+        "image": skimage.img_as_float32(img[..., 0]),
+        "noise": np.random.RandomState(0).rand(*img.shape[:2]).astype(np.float32),
+    }
+    print("sigma\tbackend\ttime s\timage max\timage mean\tnoise max\tnoise mean")
+    for sigma in sigmas:
+        refs = {k: skimage.filters.gaussian(im, sigma) for k, im in images.items()}
+        for blur in image_segmentation.BLUR_BACKENDS:
+            _, t = timeit(
+                image_segmentation.gaussian_blur, images["image"], sigma, blur=blur
+            )
+            errors = []
+            for k, im in images.items():
+                err = np.abs(
+                    image_segmentation.gaussian_blur(im, sigma, blur) - refs[k]
+                )
+                errors += [err.max(), err.mean()]
+            print(
+                "%g\t%s\t%.4f\t%.5f\t%.5f\t%.5f\t%.5f"
+                % ((sigma, blur, t) + tuple(errors))
+            )
+    args = dict(sigma_min=0.5, sigma_max=20)
+    _, t_exact = timeit(image_segmentation.compute_features, img, **args)
+    for blur in image_segmentation.BLUR_BACKENDS[1:]:
+        _, t = timeit(image_segmentation.compute_features, img, blur=blur, **args)
+        print("compute_features %s\t%.4f s (exact %.4f s)" % (blur, t, t_exact))
+
+
+def _peak_memory(f, *args, **kwargs):
+    """Returns the result of f(*args, **kwargs) and the peak memory it
+    allocated (as traced by tracemalloc, which sees numpy's buffers)"""
+    tracemalloc.start()
+    try:
+        r = f(*args, **kwargs)
+        return r, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def feature_layouts(tiles=2):
+    """
+    Times and peak memory of computing the features of the example image
+    (tiled tiles x tiles times) and predicting its unlabelled pixels, with the
+    (n_features,) + spatial shape layout and its transposed rows, and with
+    the pixel major layout and image_segmentation.predict_rows.
+    """
+    img, mask = load_example_mask()
+    height, width = mask.shape
+    img = np.tile(img, (tiles, tiles, 1))
+    mask = np.pad(mask, [(0, height * (tiles - 1)), (0, width * (tiles - 1))])
+    _, clf = image_segmentation.trainable_segmentation(
+        img, mask, max_training_pixels=5000
+    )
+    unlabelled = mask == 0
+
+    def feature_major():
+        features = image_segmentation.compute_features(img)
+        return clf.predict(features[:, unlabelled].T)
+
+    def pixel_major():
+        features = image_segmentation.compute_features(img, pixel_major=True)
+        return image_segmentation.predict_rows(
+            clf, features, np.flatnonzero(unlabelled)
+        )
+
+    print("%.1f megapixels" % (img.shape[0] * img.shape[1] / 1e6,))
+    results = []
+    for name, f in [("feature major", feature_major), ("pixel major", pixel_major)]:
+        r, t = timeit(f, repeat=1)
+        _, peak = _peak_memory(f)
+        results.append(r)
+        print("%s\t%.2f s\t%.0f MB peak" % (name, t, peak / 2 ** 20))
+    assert np.array_equal(*results)
+
+
+def superpixel_modes(methods=("slic", "felzenszwalb")):
+    """
+    Times training and predicting the example image per pixel and per
+    superpixel, with the accuracy of each on the pixels of a held out stroke
+    of each class and the agreement of the superpixel segmentations with the
+    per pixel one.
+    """
+    img, shapes = load_example()
+    height, width = img.shape[:2]
+    layers = [n % 3 + 1 for n in range(len(shapes))]
+    _, shape_masks = shape_utils.shapes_to_mask(
+        [dict(shape=s, width=width, height=height) for s in shapes],
+        layers,
+        return_shape_masks=True,
+    )
+    # the last stroke of each class is held out
+    held_out = {layer: n for n, layer in enumerate(layers)}
+    test = np.zeros((height, width), dtype=np.uint8)
+    mask = np.zeros((height, width), dtype=np.uint8)
+    for n, (layer, shape_mask) in enumerate(zip(layers, shape_masks)):
+        (test if held_out[layer] == n else mask)[shape_mask] = layer
+    tested = (test > 0) & (mask == 0)
+
+    def segment(superpixels=None):
+        return image_segmentation.trainable_segmentation(
+            img, mask, max_training_pixels=20000, superpixels=superpixels
+        )[0]
+
+    print("mode\ttime s\theld out accuracy\tagreement")
+    ref, t_ref = timeit(segment, repeat=1)
+    accuracy = (ref[tested] == test[tested]).mean()
+    print("pixels\t%.2f\t%.4f\t1" % (t_ref, accuracy))
+    for method in methods:
+        segments, t_segments = timeit(
+            image_segmentation.compute_superpixels, img, method, repeat=1
+        )
+        seg, t = timeit(segment, method, repeat=1)
+        print(
+            "%s (%d superpixels, %.2f s to compute)\t%.2f (%.1fx)\t%.4f (%+.4f)\t%.4f"
+            % (
+                method,
+                segments.max() + 1,
+                t_segments,
+                t,
+                t_ref / t,
+                (seg[tested] == test[tested]).mean(),
+                (seg[tested] == test[tested]).mean() - accuracy,
+                (seg == ref).mean(),
+            )
+        )
+
+
+def feature_backends(n_jobs=2):
+    """
+    Times computing the features of the example image serially and with
+    n_jobs threads and processes, and checks that the features are the same.
+    """
+    img, _ = load_example()
+    ref, t_ref = timeit(image_segmentation.compute_features, img, repeat=1)
+    print("serial\t%.2f s" % (t_ref,))
+    for backend in ["thread", "process"]:
+        features, t = timeit(
+            image_segmentation.compute_features,
+            img,
+            n_jobs=n_jobs,
+            backend=backend,
+            repeat=1,
+        )
+        print("%s, n_jobs=%d\t%.2f s" % (backend, n_jobs, t))
+        assert np.array_equal(ref, features)
+
+
+def tiled_features(tile_size=256):
+    """
+    Times computing the features of the example image and classifying it in
+    tiles of tile_size against the whole image, and checks that the features
+    and labels of the tiles are those of the whole image.
+    """
+    img, mask = load_example_mask()
+    height, width = mask.shape
+    whole, t_whole = timeit(
+        image_segmentation.compute_features, img, pixel_major=True, repeat=1
+    )
+    whole = whole.reshape((height, width, -1))
+
+    def tiled():
+        features = np.empty_like(whole)
+        for tile, tile_features in image_segmentation.compute_features_tiled(
+            img, tile_size, pixel_major=True
+        ):
+            features[tile] = tile_features
+        return features
+
+    features, t_tiled = timeit(tiled, repeat=1)
+    print("features\twhole %.2f s\ttiles %.2f s" % (t_whole, t_tiled))
+    assert np.array_equal(whole, features)
+    _, clf = image_segmentation.trainable_segmentation(
+        img, mask, max_training_pixels=5000, n_estimators=20
+    )
+    whole, t_whole = timeit(
+        image_segmentation.trainable_segmentation, img, clf=clf, repeat=1
+    )
+    part, t_tiled = timeit(
+        image_segmentation.trainable_segmentation,
+        img,
+        clf=clf,
+        tile_size=tile_size,
+        repeat=1,
+    )
+    print("predict\twhole %.2f s\ttiles %.2f s" % (t_whole, t_tiled))
+    assert np.array_equal(whole[0], part[0])
+
+
+def roi_prediction(roi=(200, 500, 300, 700)):
+    """
+    Times segmenting the region of interest roi of the example image against
+    the whole image, with a classifier trained beforehand and with training,
+    and checks that the region's labels are those of the whole image.
+    """
+    img, mask = load_example_mask()
+    region = image_segmentation.roi_slices(roi, mask.shape)
+    args = dict(max_training_pixels=5000, n_estimators=20, training_seed=0)
+    (_, clf), t_full = timeit(
+        image_segmentation.trainable_segmentation, img, mask, repeat=1, **args
+    )
+    part, t_part = timeit(
+        image_segmentation.trainable_segmentation, img, mask, roi=roi, repeat=1, **args
+    )
+    print("roi %r, %.0f%% of the image" % (roi, 100 * part[0].size / mask.size))
+    print("train and predict\twhole %.2f s\troi %.2f s" % (t_full, t_part))
+    whole, t_full = timeit(image_segmentation.trainable_segmentation, img, clf=clf)
+    part, t_part = timeit(
+        image_segmentation.trainable_segmentation, img, clf=clf, roi=roi
+    )
+    print("predict\twhole %.2f s\troi %.2f s" % (t_full, t_part))
+    assert np.array_equal(whole[0][region], part[0])
+
+
+def _concurrent_segmentation(args):
+    """Latency of a segmentation of the example image started at start"""
+    start, budget_dir, n_cpus = args
+    img, mask = load_example_mask()
+    budget = None if budget_dir is None else job_utils.CPUBudget(budget_dir, n_cpus)
+    time_to_start = start - time()
+    if time_to_start > 0:
+        sleep(time_to_start)
+    image_segmentation.trainable_segmentation(
+        img,
+        mask,
+        max_training_pixels=5000,
+        n_estimators=20,
+        feature_n_jobs=-1,
+        cpu_budget=budget,
+    )
+    return time() - start, None if budget is None else budget.stats()
+
+
+def cpu_budget_latency(n_requests=4):
+    """
+    Latencies of n_requests segmentations started at the same time in as many
+    processes (like gunicorn workers), each using all the cores and sharing
+    them through a job_utils.CPUBudget.
+    """
+    n_cpus = os.cpu_count()
+    print("%d cores, %d concurrent segmentations" % (n_cpus, n_requests))
+    with tempfile.TemporaryDirectory() as budget_dir:
+        for name, directory in [("all cores", None), ("cpu budget", budget_dir)]:
+            start = time() + 2
+            # not multiprocessing.Pool, whose daemonic workers can't start the
+            # workers of the forest
+            with ProcessPoolExecutor(n_requests) as pool:
+                results = pool.map(
+                    _concurrent_segmentation,
+                    [(start, directory, n_cpus)] * n_requests,
+                )
+                results = list(results)
+            latencies = sorted(r[0] for r in results)
+            print(
+                "%s\tmedian %.2f s\tmax %.2f s"
+                % (name, np.median(latencies), latencies[-1])
+            )
+            if directory is not None:
+                stats = [r[1] for r in results]
+                print(
+                    "\twaited %d of %d allocations, max wait %.2f s"
+                    % (
+                        sum(st["n_waited"] for st in stats),
+                        sum(st["n_acquired"] for st in stats),
+                        max(st["max_wait_time"] for st in stats),
+                    )
+                )
+
+
+def forest_export():
+    """
+    Compares the classifier.json file the webapp used to download (a pickled
+    scikit-learn forest) with the .npz file of forest_utils.save_forest: their
+    sizes, load times and predictions on the features of the example image,
+    checking that ForestModel gives the same probabilities with scikit-learn's
+    trees and with numpy.
+    """
+    img, mask = load_example_mask()
+    _, clf = image_segmentation.trainable_segmentation(img, mask)
+    X = image_segmentation.compute_features(img, pixel_major=True)
+    with tempfile.TemporaryDirectory() as directory:
+        json_path = os.path.join(directory, "classifier.json")
+        npz_path = os.path.join(directory, "classifier.npz")
+        with open(json_path, "w") as fd:
+            json.dump({"classifier": base64.b64encode(pickle.dumps(clf)).decode()}, fd)
+        forest_utils.save_forest(npz_path, clf)
+        print(
+            "%d trees\tjson %.2f MB\tnpz %.2f MB"
+            % (
+                len(clf.estimators_),
+                os.path.getsize(json_path) / 2 ** 20,
+                os.path.getsize(npz_path) / 2 ** 20,
+            )
+        )
+
+        def unpickle():
+            with open(json_path) as fd:
+                data = base64.b64decode(json.load(fd)["classifier"])
+            return pickle.load(io.BytesIO(data))
+
+        _, t_pickle = timeit(unpickle)
+        (model, _), t_mmap = timeit(forest_utils.load_forest, npz_path)
+        _, t_read = timeit(forest_utils.load_forest, npz_path, mmap=False)
+        print(
+            "load\tunpickle %.3f s\tnpz mmap %.3f s\tnpz read %.3f s"
+            % (t_pickle, t_mmap, t_read)
+        )
+        expected, t_sklearn = timeit(clf.predict_proba, X, repeat=1)
+        proba, t_trees = timeit(model.predict_proba, X, repeat=1)
+        numpy_model = forest_utils.ForestModel(model.arrays, use_sklearn=False)
+        numpy_proba, t_numpy = timeit(numpy_model.predict_proba, X, repeat=1)
+        print(
+            "predict %d rows\tscikit-learn %.2f s\tnpz with scikit-learn trees "
+            "%.2f s\tnpz with numpy %.2f s" % (len(X), t_sklearn, t_trees, t_numpy)
+        )
+        assert np.array_equal(proba, numpy_proba)
+        agreement = np.mean(expected.argmax(axis=1) == proba.argmax(axis=1))
+        print(
+            "label agreement %.4f\tmax probability difference %.2g"
+            % (agreement, np.abs(expected - proba).max())
+        )
+        del model
+
+
+def feature_subsets():
+    """
+    Number of features the forest of trainable_segmentation and a shallow
+    forest use for the example image, and the time compute_features takes to
+    compute only those (see forest_utils.used_features) against all of them,
+    checking that the predictions don't change.
+    """
+    from sklearn.ensemble import RandomForestClassifier
+
+    img, mask = load_example_mask()
+    layout = image_segmentation.feature_layout(img.shape)
+    features, t_all = timeit(image_segmentation.compute_features, img, pixel_major=True)
+    _, default = image_segmentation.trainable_segmentation(img, mask)
+    selected = image_segmentation.training_pixels(mask)
+    shallow = RandomForestClassifier(n_estimators=10, max_depth=4, random_state=0)
+    shallow.fit(features[np.flatnonzero(selected)], mask[selected])
+    print("all %d features\t%.2f s" % (len(layout), t_all))
+    for name, clf in [("default forest", default), ("10 trees of depth 4", shallow)]:
+        used = forest_utils.used_features(clf)
+        subset, t_subset = timeit(
+            image_segmentation.compute_features,
+            img,
+            pixel_major=True,
+            feature_subset=used,
+        )
+        print(
+            "%s\t%d features at %d of %d (channel, sigma) pairs\t%.2f s"
+            % (
+                name,
+                len(used),
+                len(set(layout[i][:2] for i in used)),
+                len(set(f[:2] for f in layout)),
+                t_subset,
+            )
+        )
+        assert np.array_equal(clf.predict(subset), clf.predict(features))
+
+
+def batch_pipeline(n_images=12, n_workers=1):
+    """
+    Times classifying n_images crops of the example image with the batch mode
+    of use_ml_image_segmentation_classifier.py, whose pipeline overlaps
+    reading and writing images with classifying them, against classifying
+    them one after the other with the same loaded classifier.
+    """
+    cli = use_ml_image_segmentation_classifier
+    img, mask = load_example_mask()
+    height, width = mask.shape
+    _, clf = image_segmentation.trainable_segmentation(
+        img, mask, max_training_pixels=5000, n_estimators=20
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        clf_path = os.path.join(directory, "classifier.npz")
+        forest_utils.save_forest(
+            clf_path, clf, segmenter_args={}, label_to_colors_args={}
+        )
+        img_dir = os.path.join(directory, "images")
+        os.makedirs(img_dir)
+        for i in range(n_images):
+            crop = img[i * 8 : i * 8 + height // 2, i * 16 : i * 16 + width // 2]
+            skimage.io.imsave(os.path.join(img_dir, "%03d.png" % (i,)), crop)
+        model, _ = forest_utils.load_forest(clf_path)
+        t = time()
+        for i in range(n_images):
+            out = os.path.join(directory, "%03d.png" % (i,))
+            cli.use_img_classifier_in_mem(
+                model,
+                {},
+                {},
+                os.path.join(img_dir, "%03d.png" % (i,)),
+                out,
+                out_blend=out,
+            )
+        t_sequential = time() - t
+        t = time()
+        _, _, failed, stats = cli.use_img_classifier_batch(
+            clf_path,
+            img_dir,
+            os.path.join(directory, "seg"),
+            os.path.join(directory, "blend"),
+            n_workers=n_workers,
+        )
+        t_batch = time() - t
+        assert len(failed) == 0
+    print(
+        "%d images\tsequential %.2f s\tbatch with %d workers %.2f s"
+        % (n_images, t_sequential, n_workers, t_batch)
+    )
+    for name, st in stats.items():
+        print(
+            "\t%s\tbusy %.2f s\tstarved %.2f s\tblocked %.2f s"
+            % (name, st["busy_time"], st["starved_time"], st["blocked_time"])
+        )
+
+
+def inference_server_latency(n_requests=4):
+    """
+    Latency of classifying a crop of the example image by running
+    use_ml_image_segmentation_classifier.py against posting it to a warm
+    inference_server (through Flask's test client), alone and as
+    n_requests concurrent requests whose predictions are batched, checking
+    that the server refuses paths outside of its directories.
+    """
+    import inference_server
+
+    img, mask = load_example_mask()
+    height, width = mask.shape
+    _, clf = image_segmentation.trainable_segmentation(
+        img, mask, max_training_pixels=5000, n_estimators=20
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        clf_path = os.path.join(directory, "classifier.npz")
+        forest_utils.save_forest(
+            clf_path, clf, segmenter_args={}, label_to_colors_args={}
+        )
+        img_path = os.path.join(directory, "img.png")
+        skimage.io.imsave(img_path, img[: height // 2, : width // 2])
+        out_path = os.path.join(directory, "out.png")
+        env = dict(
+            os.environ,
+            CLF_PATH=clf_path,
+            IMG_PATH=img_path,
+            OUT_IMG_PATH=out_path,
+            OUT_BLEND_PATH=out_path,
+        )
+        t = time()
+        subprocess.run(
+            [sys.executable, "use_ml_image_segmentation_classifier.py"],
+            env=env,
+            check=True,
+        )
+        t_cli = time() - t
+        form = dict(classifier=clf_path, image_path=img_path)
+        inference_server.CLASSIFIER_DIR = os.path.realpath(directory)
+        inference_server.IMAGE_DIR = inference_server.CLASSIFIER_DIR
+        client = inference_server.app.test_client()
+        # paths outside of the server's directories are refused
+        outside = dict(form, image_path=os.path.join(directory, "..", "img.png"))
+        assert client.post("/segment", data=outside).status_code == 403
+        # loads the classifier
+        client.post("/segment", data=form)
+        _, t_warm = timeit(client.post, "/segment", data=form)
+        latencies = []
+
+        def request():
+            t = time()
+            response = inference_server.app.test_client().post("/segment", data=form)
+            assert response.status_code == 200
+            latencies.append(time() - t)
+
+        threads = [threading.Thread(target=request) for _ in range(n_requests)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        batches = client.get("/stats").json["batches"]
+    print("script %.2f s\tserver %.2f s" % (t_cli, t_warm))
+    print(
+        "%d concurrent requests\tmedian %.2f s\tmax %.2f s"
+        % (n_requests, np.median(latencies), max(latencies))
+    )
+    for st in batches.values():
+        print(
+            "%d predict calls in %d batches, up to %d calls per batch"
+            % (st["n_calls"], st["n_batches"], st["max_batch_calls"])
+        )
+
+
+BENCHMARKS = {
+    "rasterizer": rasterizer_fidelity,
+    "label_to_colors": label_to_colors_lut,
+    "scale_spaces": scale_spaces,
+    "blur": blur_backends,
+    "feature_layout": feature_layouts,
+    "superpixels": superpixel_modes,
+    "feature_backends": feature_backends,
+    "tiles": tiled_features,
+    "roi": roi_prediction,
+    "cpu_budget": cpu_budget_latency,
+    "forest_export": forest_export,
+    "feature_subset": feature_subsets,
+    "batch_pipeline": batch_pipeline,
+    "inference_server": inference_server_latency,
+}
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1] not in BENCHMARKS:
+        print(__doc__)
+        print("NAME: " + ", ".join(BENCHMARKS.keys()))
+        sys.exit(1)
+    BENCHMARKS[sys.argv[1]]()
@@ -0,0 +1,247 @@
+import fcntl
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+def array_digest(arr):
+    """
+    Returns a hex digest identifying the contents of the numpy array arr
+    (its dtype, shape and data).
+    """
+    arr = np.ascontiguousarray(arr)
+    h = hashlib.sha1()
+    h.update(str(arr.dtype).encode())
+    h.update(str(arr.shape).encode())
+    h.update(arr.data)
+    return h.hexdigest()
+
+
+def nbytes_of(value):
+    """
+    Size estimate of a cached value: numpy arrays count their buffer, tuples and
+    lists the sum of their items, anything else counts as 0.
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(nbytes_of(v) for v in value)
+    return 0
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache bounded by the total number of bytes
+    of the stored values (as estimated by nbytes_of) and optionally by the
+    number of entries.
+    A value larger than max_bytes is never stored.
+    """
+
+    def __init__(self, max_bytes, max_entries=None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, _ = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = nbytes_of(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.nbytes += size
+            self._evict()
+
+    def items(self):
+        """(key, value) of the entries, least recently used first"""
+        with self._lock:
+            return [(key, value) for key, (value, _) in self._entries.items()]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            value, size = self._entries.pop(key)
+            self.nbytes -= size
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def _evict(self):
+        while self._entries and (
+            self.nbytes > self.max_bytes
+            or (self.max_entries is not None and len(self._entries) > self.max_entries)
+        ):
+            _, (_, size) = self._entries.popitem(last=False)
+            self.nbytes -= size
+
+
+class DiskCache:
+    """
+    Least-recently-used cache of bytes values stored as files of directory,
+    named by their key (a hex digest), so that it can be shared by processes,
+    e.g. gunicorn workers.
+    The total size of the files is bounded by max_bytes and, if ttl is not
+    None, entries not used for ttl seconds expire. The last use of an entry is
+    the modification time of its file.
+    Values are written to a temporary file which is then renamed, so readers
+    never see partial values, and eviction is serialized between processes
+    with a lock file.
+    """
+
+    _KEY_RE = re.compile("[0-9a-f]+")
+    _TMP_PREFIX = ".tmp-"
+    # seconds after which a temporary file is assumed to be abandoned
+    STALE_TMP_AGE = 3600
+
+    def __init__(self, directory, max_bytes, ttl=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        if not self._KEY_RE.fullmatch(key):
+            raise ValueError("Keys must be hex digests, got %r" % (key,))
+        return os.path.join(self.directory, key)
+
+    def _expired(self, mtime, now):
+        return self.ttl is not None and now - mtime > self.ttl
+
+    def _entries(self):
+        """(modification time, size, path) of the entries, oldest first"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not self._KEY_RE.fullmatch(entry.name):
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+        return sorted(entries)
+
+    def _locked(self):
+        """Open lock file, locked until it is closed"""
+        fd = open(os.path.join(self.directory, ".lock"), "a")
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def _live_entries(self):
+        now = time.time()
+        return [e for e in self._entries() if not self._expired(e[0], now)]
+
+    def __len__(self):
+        return len(self._live_entries())
+
+    def __contains__(self, key):
+        try:
+            mtime = os.stat(self._path(key)).st_mtime
+        except FileNotFoundError:
+            return False
+        return not self._expired(mtime, time.time())
+
+    @property
+    def nbytes(self):
+        return sum(size for _, size, _ in self._live_entries())
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as fd:
+                if self._expired(os.fstat(fd.fileno()).st_mtime, time.time()):
+                    raise FileNotFoundError(path)
+                value = fd.read()
+            # mark as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        if len(value) > self.max_bytes:
+            return
+        fd, tmp_path = tempfile.mkstemp(prefix=self._TMP_PREFIX, dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(value)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self._evict()
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+        return value
+
+    def clear(self):
+        with self._locked():
+            for entry in os.scandir(self.directory):
+                if entry.name != ".lock":
+                    try:
+                        os.unlink(entry.path)
+                    except FileNotFoundError:
+                        pass
+
+    def _evict(self):
+        with self._locked():
+            now = time.time()
+            # temporary files left by processes killed while writing
+            for entry in os.scandir(self.directory):
+                if entry.name.startswith(self._TMP_PREFIX):
+                    try:
+                        if now - entry.stat().st_mtime > self.STALE_TMP_AGE:
+                            os.unlink(entry.path)
+                    except FileNotFoundError:
+                        pass
+            entries = self._entries()
+            nbytes = sum(size for _, size, _ in entries)
+            for mtime, size, path in entries:
+                if nbytes <= self.max_bytes and not self._expired(mtime, now):
+                    continue
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                nbytes -= size
@@ -0,0 +1,373 @@
+__doc__ = """
+Pickle-free export of the random forests of trainable segmentation.
+
+A forest is flattened into typed node arrays, saved in an uncompressed .npz
+file with the parameters needed to use it, and evaluated with the compiled
+trees of scikit-learn if it is installed, or with numpy alone, so that using
+a classifier doesn't need scikit-learn (or unpickling). The arrays of a saved
+forest can be memory mapped instead of read.
+
+"""
+
+import json
+import threading
+import warnings
+import zipfile
+import numpy as np
+
+# version of the arrays written by save_forest
+FOREST_FORMAT = 1
+
+# number of rows ForestModel.predict evaluates at a time, which bounds the
+# memory of the node indices of each (tree, row) pair and keeps the rows in
+# the CPU caches
+FOREST_CHUNK_SIZE = 2 ** 12
+
+# number of rows on which the scikit-learn trees of a ForestModel are checked
+# to give the probabilities of numpy before they are used
+SKLEARN_CHECK_ROWS = 2 ** 8
+
+
+def _round_down_float32(x):
+    """
+    Largest float32 values not above the float64 values x, so that for
+    float32 features f, f <= x if and only if f <= _round_down_float32(x).
+    """
+    y = x.astype(np.float32)
+    above = y.astype(np.float64) > x
+    y[above] = np.nextafter(y[above], np.float32(-np.inf))
+    return y
+
+
+def export_forest(clf):
+    """
+    Flattens the trees of the fitted scikit-learn forest classifier clf into
+    a dict of arrays, the nodes of all trees following each other:
+        - feature, threshold: a row x goes to the left child of an internal
+          node if x[feature] <= threshold (as in scikit-learn, which compares
+          float32 features),
+        - children: (n_nodes, 2) indices of the left and right children;
+          leaves are their own children, with the threshold inf,
+        - leaf: row of leaf_proba of a leaf, -1 for internal nodes,
+        - leaf_proba: class probabilities of each leaf,
+        - roots: index of the root of each tree,
+        - classes: the labels of the classes (clf.classes_),
+        - max_depth and n_features.
+    """
+    features, thresholds, children, leaves, probas, roots = [], [], [], [], [], []
+    offset = 0
+    n_leaves = 0
+    max_depth = 0
+    for estimator in clf.estimators_:
+        tree = estimator.tree_
+        n_nodes = tree.node_count
+        node = np.arange(n_nodes)
+        is_leaf = tree.children_left == -1
+        leaf = np.full(n_nodes, -1)
+        leaf[is_leaf] = n_leaves + np.arange(is_leaf.sum())
+        value = tree.value[is_leaf, 0, :]
+        probas.append(value / value.sum(axis=1, keepdims=True))
+        features.append(np.where(is_leaf, 0, tree.feature))
+        thresholds.append(np.where(is_leaf, np.inf, tree.threshold))
+        children.append(
+            np.stack(
+                [
+                    np.where(is_leaf, node, tree.children_left),
+                    np.where(is_leaf, node, tree.children_right),
+                ],
+                axis=1,
+            )
+            + offset
+        )
+        leaves.append(leaf)
+        roots.append(offset)
+        offset += n_nodes
+        n_leaves += is_leaf.sum()
+        max_depth = max(max_depth, tree.max_depth)
+    return {
+        "feature": np.concatenate(features).astype(np.int32),
+        "threshold": _round_down_float32(np.concatenate(thresholds)),
+        "children": np.concatenate(children).astype(np.int32),
+        "leaf": np.concatenate(leaves).astype(np.int32),
+        "leaf_proba": np.concatenate(probas).astype(np.float32),
+        "roots": np.array(roots, dtype=np.int32),
+        "classes": np.asarray(clf.classes_),
+        "max_depth": np.array(max_depth),
+        # n_features_in_ replaced n_features_ in scikit-learn 0.24
+        "n_features": np.array(getattr(clf, "n_features_in_", None) or clf.n_features_),
+    }
+
+
+def _sklearn_trees(arrays):
+    """
+    The trees of the arrays of export_forest as scikit-learn Tree objects, or
+    None if scikit-learn isn't installed. Tree is not part of its public API,
+    so the trees must be checked (see ForestModel.sklearn_trees).
+    """
+    try:
+        from sklearn.tree._tree import NODE_DTYPE, Tree
+    except ImportError:
+        return None
+    n_classes = np.array([len(arrays["classes"])], dtype=np.intp)
+    bounds = list(arrays["roots"]) + [len(arrays["leaf"])]
+    trees = []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        node = np.arange(stop - start)
+        leaf = arrays["leaf"][start:stop]
+        is_leaf = leaf >= 0
+        children = arrays["children"][start:stop] - start
+        nodes = np.zeros(len(node), dtype=NODE_DTYPE)
+        # scikit-learn's leaves have no children, feature and threshold
+        nodes["left_child"] = np.where(is_leaf, -1, children[:, 0])
+        nodes["right_child"] = np.where(is_leaf, -1, children[:, 1])
+        nodes["feature"] = np.where(is_leaf, -2, arrays["feature"][start:stop])
+        nodes["threshold"] = np.where(is_leaf, -2, arrays["threshold"][start:stop])
+        values = np.zeros((len(node), 1, n_classes[0]))
+        values[is_leaf, 0] = arrays["leaf_proba"][leaf[is_leaf]]
+        tree = Tree(int(arrays["n_features"]), n_classes, 1)
+        tree.__setstate__(
+            {
+                "max_depth": int(arrays["max_depth"]),
+                "node_count": len(node),
+                "nodes": nodes,
+                "values": values,
+            }
+        )
+        trees.append(tree)
+    return trees
+
+
+def _check_rows(arrays, n_rows, seed=0):
+    """
+    n_rows rows whose features are thresholds of the splits of the forest on
+    them, or the next float32 values, which take both branches of the splits.
+    """
+    rng = np.random.RandomState(seed)
+    split = arrays["leaf"] < 0
+    features = arrays["feature"][split]
+    thresholds = arrays["threshold"][split]
+    X = np.zeros((n_rows, int(arrays["n_features"])), dtype=np.float32)
+    for j in np.unique(features):
+        X[:, j] = rng.choice(thresholds[features == j], n_rows)
+    above = rng.rand(*X.shape) < 0.5
+    X[above] = np.nextafter(X[above], np.float32(np.inf))
+    return X
+
+
+class ForestModel:
+    """
+    Random forest classifier evaluated from the arrays of export_forest, with
+    the predict and predict_proba methods of scikit-learn's (which give the
+    same results up to the float32 rounding of the leaf probabilities).
+    If use_sklearn is True and scikit-learn is installed, the trees are
+    converted to scikit-learn trees on the first prediction and evaluated by
+    its compiled code, which is several times faster than numpy. As they are
+    built with its private API, they are only used if they give the same
+    probabilities as numpy on SKLEARN_CHECK_ROWS rows, with a warning
+    otherwise.
+    """
+
+    def __init__(self, arrays, chunk_size=FOREST_CHUNK_SIZE, use_sklearn=True):
+        # plain arrays, memory mapped or not, as memmap objects are slower
+        self.arrays = {k: np.asarray(v) for k, v in arrays.items()}
+        self.classes_ = np.asarray(arrays["classes"])
+        self.n_features_in_ = int(arrays["n_features"])
+        self.max_depth = int(arrays["max_depth"])
+        self.chunk_size = chunk_size
+        self.use_sklearn = use_sklearn
+        self._trees = None
+        self._trees_lock = threading.Lock()
+
+    @property
+    def n_trees(self):
+        return len(self.arrays["roots"])
+
+    def sklearn_trees(self):
+        """The scikit-learn trees of the forest, None if they can't be used"""
+        if not self.use_sklearn:
+            return None
+        with self._trees_lock:
+            if self._trees is None:
+                self._trees = self._checked_sklearn_trees() or []
+        return self._trees or None
+
+    def _checked_sklearn_trees(self):
+        try:
+            trees = _sklearn_trees(self.arrays)
+            if trees is None:
+                return None
+            X = _check_rows(self.arrays, SKLEARN_CHECK_ROWS)
+            if not np.allclose(
+                self._proba(X, trees), self._proba(X, None), rtol=0, atol=1e-6
+            ):
+                raise ValueError("their probabilities differ from numpy's")
+        except (KeyError, TypeError, ValueError) as e:
+            warnings.warn(
+                "The trees of this version of scikit-learn can't be used (%s), "
+                "the forest is evaluated with numpy" % (e,),
+                RuntimeWarning,
+            )
+            return None
+        return trees
+
+    def _leaves(self, X):
+        """
+        (n_trees, len(X)) rows of leaf_proba of the leaves the rows of the
+        C-contiguous array X end up in. All (tree, row) pairs go down one
+        level at a time, and the pairs that reached a leaf are dropped.
+        np.take is used as it is faster than indexing.
+        """
+        a = self.arrays
+        n_rows, n_features = X.shape
+        X = X.ravel()
+        result = np.empty(self.n_trees * n_rows, dtype=np.int32)
+        # the pairs still going down, their nodes and the start of their rows
+        pairs = np.arange(self.n_trees * n_rows, dtype=np.int32)
+        node = np.repeat(a["roots"], n_rows)
+        row_start = np.arange(n_rows, dtype=np.int32) * np.int32(n_features)
+        row_start = np.tile(row_start, self.n_trees)
+        children = a["children"].ravel()
+        for _ in range(self.max_depth + 1):
+            leaf = np.take(a["leaf"], node)
+            done = leaf >= 0
+            if done.any():
+                result[pairs[done]] = leaf[done]
+                going = ~done
+                pairs, node, row_start = pairs[going], node[going], row_start[going]
+                if len(pairs) == 0:
+                    break
+            x = np.take(X, row_start + np.take(a["feature"], node))
+            node = np.take(children, 2 * node + (x > np.take(a["threshold"], node)))
+        return result.reshape((self.n_trees, n_rows))
+
+    def predict_proba(self, X):
+        """Mean class probabilities of the trees for the rows of X"""
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features_in_:
+            raise ValueError(
+                "Expected rows of %d features, got shape %r"
+                % (self.n_features_in_, X.shape)
+            )
+        return self._proba(X, self.sklearn_trees())
+
+    def _proba(self, X, trees):
+        """
+        predict_proba of the float32 rows X, with the scikit-learn trees or
+        with numpy if trees is None
+        """
+        proba = np.zeros((len(X), len(self.classes_)))
+        leaf_proba = self.arrays["leaf_proba"]
+        for start in range(0, len(X), self.chunk_size):
+            chunk = slice(start, start + self.chunk_size)
+            if trees is not None:
+                for tree in trees:
+                    proba[chunk] += tree.predict(X[chunk])
+            else:
+                leaves = self._leaves(X[chunk])
+                proba[chunk] = np.take(leaf_proba, leaves, axis=0).sum(
+                    axis=0, dtype=np.float64
+                )
+        proba /= self.n_trees
+        return proba
+
+    def predict(self, X):
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+
+def used_features(clf):
+    """
+    Sorted indices of the features the splits of the forest clf use, where
+    clf is a fitted scikit-learn forest or a ForestModel, or None for other
+    classifiers (which may use any feature). Other classifiers can give them
+    with a used_features method (e.g. wrappers of forests).
+    """
+    if hasattr(clf, "used_features"):
+        return clf.used_features()
+    if isinstance(clf, ForestModel):
+        a = clf.arrays
+        return np.unique(a["feature"][a["leaf"] < 0])
+    estimators = getattr(clf, "estimators_", None)
+    if estimators is None or not all(hasattr(e, "tree_") for e in estimators):
+        return None
+    # leaves have negative features
+    features = np.concatenate([e.tree_.feature for e in estimators])
+    return np.unique(features[features >= 0])
+
+
+def save_forest(path, clf, **metadata):
+    """
+    Saves the forest classifier clf (see export_forest) to the .npz file path,
+    uncompressed so that load_forest can memory map it, with the JSON
+    serializable keyword arguments (e.g. segmenter_args) as metadata.
+    """
+    np.savez(
+        path,
+        format=np.array(FOREST_FORMAT),
+        metadata=np.array(json.dumps(metadata)),
+        **export_forest(clf)
+    )
+
+
+def _npz_member_offset(fd, info):
+    """Offset in the zip file fd of the data of the member info"""
+    fd.seek(info.header_offset)
+    header = fd.read(30)
+    if header[:4] != b"PK\x03\x04":
+        raise ValueError("Bad zip member %r" % (info.filename,))
+    name_length = int.from_bytes(header[26:28], "little")
+    extra_length = int.from_bytes(header[28:30], "little")
+    return info.header_offset + 30 + name_length + extra_length
+
+
+def _mmap_npz(path):
+    """
+    Arrays of the uncompressed .npz file path, as read-only memory maps of
+    the file.
+    """
+    arrays = {}
+    with open(path, "rb") as fd, zipfile.ZipFile(fd) as zf:
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError("Compressed member %r" % (info.filename,))
+            fd.seek(_npz_member_offset(fd, info))
+            version = np.lib.format.read_magic(fd)
+            if version == (1, 0):
+                header = np.lib.format.read_array_header_1_0(fd)
+            else:
+                header = np.lib.format.read_array_header_2_0(fd)
+            shape, fortran_order, dtype = header
+            if dtype.hasobject:
+                raise ValueError("Object array %r" % (info.filename,))
+            name = info.filename[: -len(".npy")]
+            if np.prod(shape) == 0 or shape == ():
+                # np.memmap can't map empty arrays, and scalars are small
+                fd.seek(_npz_member_offset(fd, info))
+                arrays[name] = np.lib.format.read_array(fd)
+                continue
+            arrays[name] = np.memmap(
+                path,
+                dtype=dtype,
+                mode="r",
+                offset=fd.tell(),
+                shape=shape,
+                order="F" if fortran_order else "C",
+            )
+    return arrays
+
+
+def load_forest(path, mmap=True):
+    """
+    Loads a forest saved by save_forest. Returns (model, metadata) where
+    model is a ForestModel and metadata the dict of keyword arguments given
+    to save_forest. If mmap is True, the node arrays are memory mapped,
+    which makes loading independent of the size of the forest.
+    """
+    if mmap:
+        arrays = _mmap_npz(path)
+    else:
+        with np.load(path) as npz:
+            arrays = dict(npz)
+    if int(arrays["format"]) != FOREST_FORMAT:
+        raise ValueError("Unsupported forest format %r" % (int(arrays["format"]),))
+    metadata = json.loads(str(arrays.pop("metadata")))
+    return ForestModel(arrays), metadata
@@ -20,54 +20,456 @@ segmentation").
 """
 
 
+import contextlib
+import copy
 from itertools import combinations_with_replacement
-import itertools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+import os
+import threading
 import numpy as np
-from skimage import filters, feature, img_as_float32
-from sklearn.ensemble import RandomForestClassifier
+from scipy import ndimage as ndi, signal, sparse
+from skimage import filters, feature, img_as_float32, segmentation
 from time import time
+from cache_utils import LRUCache, array_digest
+from forest_utils import used_features
 
+FEATURE_TYPES = ["intensity", "edges", "texture"]
 
-def _features_sigma(img, sigma, intensity=True, edges=True, texture=True):
-    """Features for a single value of the Gaussian blurring parameter ``sigma``
+SCALE_SPACES = ["direct", "cascade", "octave"]
+
+# see _scale_space
+OCTAVE_MIN_SIGMA = 4
+
+BLUR_BACKENDS = ["exact", "recursive", "box"]
+
+# see gaussian_blur
+APPROXIMATE_BLUR_MIN_SIGMA = 6
+
+# number of pixels classified at a time by predict_rows
+PREDICT_CHUNK_SIZE = 2 ** 18
+
+# Over-segmentations of compute_superpixels and their default parameters.
+# The default number of SLIC superpixels is the number of pixels divided by
+# PIXELS_PER_SUPERPIXEL.
+SUPERPIXEL_METHODS = {
+    "slic": dict(compactness=10),
+    "felzenszwalb": dict(scale=100, sigma=0.5, min_size=50),
+}
+PIXELS_PER_SUPERPIXEL = 256
+
+# Superpixels of recently seen images, see compute_superpixels.
+SUPERPIXEL_CACHE = LRUCache(max_bytes=64 * 2 ** 20)
+
+# Feature planes of recently seen images, keyed by (image digest, channel,
+# sigma, feature type, scale space, blur). Pass it as the cache argument of
+# compute_features to reuse planes across calls on the same image.
+FEATURE_CACHE = LRUCache(max_bytes=512 * 2 ** 20)
+
+
+def _block_mean2(img):
+    """Mean of blocks of 2 pixels along every axis (odd sizes are padded with
+    the edge values)"""
+    img = np.pad(img, [(0, n % 2) for n in img.shape], mode="edge")
+    for axis in range(img.ndim):
+        even = np.take(img, np.arange(0, img.shape[axis], 2), axis=axis)
+        odd = np.take(img, np.arange(1, img.shape[axis], 2), axis=axis)
+        img = (even + odd) * np.float32(0.5)
+    return img
+
+
+def _recursive_gaussian(img, sigma):
+    """Young and van Vliet's third order recursive Gaussian filter, one causal
+    and one anti-causal pass along every axis. The image is extended with its
+    edge values, like skimage's default mode "nearest"."""
+    if sigma >= 2.5:
+        q = 0.98711 * sigma - 0.96330
+    else:
+        q = 3.97156 - 4.14554 * np.sqrt(1 - 0.26891 * sigma)
+    b0 = 1.57825 + 2.44413 * q + 1.4281 * q ** 2 + 0.422205 * q ** 3
+    b1 = 2.44413 * q + 2.85619 * q ** 2 + 1.26661 * q ** 3
+    b2 = -(1.4281 * q ** 2 + 1.26661 * q ** 3)
+    b3 = 0.422205 * q ** 3
+    a = [1, -b1 / b0, -b2 / b0, -b3 / b0]
+    b = [1 - (b1 + b2 + b3) / b0]
+    # the filter's state for a constant input of 1
+    zi = signal.lfilter_zi(b, a)
+    # the causal pass starts in the steady state of the first value; padding
+    # the end lets the anti-causal pass start from a settled state too
+    pad = int(4.0 * sigma + 0.5)
+    for axis in range(img.ndim):
+        x = np.moveaxis(img, axis, -1)
+        n = x.shape[-1]
+        x = np.concatenate((x, np.repeat(x[..., -1:], pad, axis=-1)), axis=-1)
+        y, _ = signal.lfilter(b, a, x, axis=-1, zi=zi * x[..., :1])
+        y = y[..., ::-1]
+        y, _ = signal.lfilter(b, a, y, axis=-1, zi=zi * y[..., :1])
+        img = np.moveaxis(y[..., ::-1][..., :n], -1, axis)
+    return img.astype(np.float32)
+
+
+def _box_sizes(sigma, n_boxes=3):
+    """Odd widths of n_boxes box filters whose successive application has a
+    variance as close as possible to sigma ** 2"""
+    w = int(np.sqrt(12.0 * sigma ** 2 / n_boxes + 1))
+    w -= 1 - w % 2
+    # the number of boxes of width w, the others have width w + 2
+    m = int(
+        round((12.0 * sigma ** 2 - n_boxes * (w ** 2 + 4 * w + 3)) / (-4.0 * (w + 1)))
+    )
+    return [w] * m + [w + 2] * (n_boxes - m)
+
+
+def _box_gaussian(img, sigma):
+    """Three box filters (running sums, so independent of sigma) along every
+    axis, with the edge values of the image extended"""
+    for size in _box_sizes(sigma):
+        for axis in range(img.ndim):
+            img = ndi.uniform_filter1d(img, size, axis=axis, mode="nearest")
+    return img
+
+
+def gaussian_blur(img, sigma, blur="exact"):
+    """
+    Gaussian blur of the float32 ``img`` by ``sigma`` with the ``blur`` backend:
+    "exact" is skimage.filters.gaussian, "recursive" a recursive (IIR) filter
+    and "box" three successive box filters. The approximate backends take the
+    same time for any sigma; below APPROXIMATE_BLUR_MIN_SIGMA, where
+    skimage.filters.gaussian is fast, they fall back to "exact".
+
+    Errors against skimage.filters.gaussian for images with values in [0, 1]
+    (see the "blur" benchmark), for sigma from 6 to 20:
+        - "recursive": maximum 0.007 (sigma 6) down to 0.0015 (sigma 20),
+          mean below 0.001.
+        - "box": maximum 0.08, mean below 0.001. The error is largest next to
+          sharp edges and in noise.
+    The support of "box" is smaller than the truncated kernel of "exact" (see
+    feature_halo), that of "recursive" is unbounded.
+    """
+    if blur not in BLUR_BACKENDS:
+        raise ValueError("Unknown blur backend %r" % (blur,))
+    if blur == "exact" or sigma < APPROXIMATE_BLUR_MIN_SIGMA:
+        return filters.gaussian(img, sigma)
+    if blur == "recursive":
+        return _recursive_gaussian(img, sigma)
+    return _box_gaussian(img, sigma)
+
+
+def _scale_space(img, sigmas, scale_space="direct", blur="exact"):
+    """
+    Yields (img_blur, factor) for each of the increasing ``sigmas``, where
+    img_blur is ``img`` blurred by a Gaussian of standard deviation sigma and
+    decimated by factor along every axis.
+
+    With ``scale_space`` "direct", ``img`` is blurred with each sigma. With
+    "cascade", each blurred image is obtained from the previous one with the
+    smaller blur sqrt(sigma**2 - previous_sigma**2). "octave" also halves the
+    resolution (by averaging blocks of 2 pixels) whenever the current image is
+    blurred by at least 2 pixels of the decimated image and the next sigma is at
+    least OCTAVE_MIN_SIGMA pixels of the decimated image, so that large sigmas
+    are computed on small images. "cascade" and "octave" approximate "direct".
+    Images are blurred with gaussian_blur and its ``blur`` backend.
+    """
+    if scale_space == "direct":
+        for sigma in sigmas:
+            yield gaussian_blur(img, sigma, blur), 1
+        return
+    if scale_space not in SCALE_SPACES:
+        raise ValueError("Unknown scale space %r" % (scale_space,))
+    variance = 0.0
+    factor = 1
+    for sigma in sigmas:
+        while (
+            scale_space == "octave"
+            and np.sqrt(variance) >= 2 * factor
+            and sigma >= OCTAVE_MIN_SIGMA * 2 * factor
+        ):
+            img = _block_mean2(img)
+            # averaging two pixels spaced factor apart
+            variance += factor ** 2 / 4.0
+            factor *= 2
+        if sigma ** 2 > variance:
+            img = gaussian_blur(img, np.sqrt(sigma ** 2 - variance) / factor, blur)
+            variance = sigma ** 2
+        yield img, factor
+
+
+def _upsample(plane, factor, output):
+    """Linearly interpolates ``plane``, decimated by _block_mean2 ``factor``
+    times, to the full resolution ``output`` array, one axis at a time."""
+    for axis, n in enumerate(output.shape):
+        # the center of decimated pixel i is at full resolution coordinate
+        # (i + 0.5) * factor - 0.5
+        coords = (np.arange(n) + 0.5) / factor - 0.5
+        coords = np.clip(coords, 0, plane.shape[axis] - 1)
+        i0 = np.floor(coords).astype(np.intp)
+        i1 = np.minimum(i0 + 1, plane.shape[axis] - 1)
+        shape = [1] * plane.ndim
+        shape[axis] = n
+        w = (coords - i0).astype(np.float32).reshape(shape)
+        lo = np.take(plane, i0, axis=axis)
+        plane = lo + (np.take(plane, i1, axis=axis) - lo) * w
+    output[...] = plane
+
+
+def _features_blurred(img_blur, factor, targets):
+    """Features of an image blurred by some sigma (see _scale_space).
+    ``targets`` maps each feature type to compute to the full resolution array
+    its planes are written to. The first derivatives are shared between the
+    Hessian terms. If ``factor`` is not 1, the features are computed on the
+    decimated ``img_blur``, with derivatives per full resolution pixel, and
+    then upsampled.
     """
-    features = []
-    img_blur = filters.gaussian(img, sigma)
-    if intensity:
-        features.append(img_blur)
-    if edges:
-        features.append(filters.sobel(img_blur))
-    if texture:
+    if factor != 1:
+        level_targets = {
+            ft: np.empty((len(t),) + img_blur.shape, dtype=np.float32)
+            for ft, t in targets.items()
+        }
+        _features_blurred(img_blur, 1, level_targets)
+        for ft, t in targets.items():
+            if ft == "edges":
+                level_targets[ft] /= factor
+            elif ft == "texture":
+                level_targets[ft] /= factor ** 2
+            for plane, output in zip(level_targets[ft], t):
+                _upsample(plane, factor, output)
+        return
+    if "intensity" in targets:
+        targets["intensity"][0] = img_blur
+    if "edges" in targets:
+        targets["edges"][0] = filters.sobel(img_blur)
+    if "texture" in targets:
+        gradients = np.gradient(img_blur)
         H_elems = [
-            np.gradient(np.gradient(img_blur)[ax0], axis=ax1)
-            for ax0, ax1 in combinations_with_replacement(range(img.ndim), 2)
+            np.gradient(gradients[ax0], axis=ax1)
+            for ax0, ax1 in combinations_with_replacement(range(img_blur.ndim), 2)
         ]
         eigvals = feature.hessian_matrix_eigvals(H_elems)
-        for eigval_mat in eigvals:
-            features.append(eigval_mat)
-    return features
+        for n, eigval_mat in enumerate(eigvals):
+            targets["texture"][n] = eigval_mat
 
 
-def _compute_features_gray(
-    img, intensity=True, edges=True, texture=True, sigma_min=0.5, sigma_max=16
-):
-    """Features for a single channel image. ``img`` can be 2d or 3d.
-    """
-    # computations are faster as float32
-    img = img_as_float32(img)
-    sigmas = np.logspace(
+def _n_feature_planes(feature_type, ndim):
+    """Number of planes a feature type contributes for each sigma"""
+    return ndim if feature_type == "texture" else 1
+
+
+def _sigmas(sigma_min, sigma_max):
+    """Values of sigma at which features are computed: sigma_min, the powers of
+    2 between sigma_min and sigma_max, and sigma_max. As the sigmas in between
+    are on a fixed grid, moving an end of the range only changes the sigma of
+    that end, and the planes of the others can be found in a feature cache."""
+    # tolerance for bounds that are powers of 2 up to rounding
+    eps = 1e-9
+    exponents = np.arange(
+        np.floor(np.log2(sigma_min) + eps) + 1, np.ceil(np.log2(sigma_max) - eps)
+    )
+    sigmas = [float(sigma_min)] + list(2.0 ** exponents)
+    if sigma_max > sigma_min:
+        sigmas.append(float(sigma_max))
+    return np.array(sigmas)
+
+
+def _legacy_sigmas(sigma_min, sigma_max):
+    """Sigmas of the features of classifiers saved without their sigmas (see
+    check_sigmas), which were spaced evenly in log scale"""
+    return np.logspace(
         np.log2(sigma_min),
         np.log2(sigma_max),
         num=int(np.log2(sigma_max) - np.log2(sigma_min) + 1),
         base=2,
         endpoint=True,
     )
-    n_sigmas = len(sigmas)
-    all_results = [
-        _features_sigma(img, sigma, intensity=intensity, edges=edges, texture=texture)
-        for sigma in sigmas
+
+
+def feature_sigmas(sigma_min=0.5, sigma_max=16, **kwargs):
+    """
+    The list of sigmas of the features of the range sigma_min to sigma_max.
+    Other keyword arguments (e.g. the rest of a classifier's segmenter_args)
+    are ignored.
+    """
+    return [float(sigma) for sigma in _sigmas(sigma_min, sigma_max)]
+
+
+def check_sigmas(segmenter_args, sigmas=None):
+    """
+    Raises ValueError if sigmas, the sigmas of the features a classifier was
+    trained with (saved with it, see feature_sigmas), are not the sigmas of
+    the features computed with its segmenter_args, so that a classifier isn't
+    silently given other features than it was trained on. Classifiers saved
+    without their sigmas (sigmas is None) were trained on the features of
+    _legacy_sigmas.
+    """
+    if sigmas is None:
+        sigmas = _legacy_sigmas(
+            segmenter_args.get("sigma_min", 0.5), segmenter_args.get("sigma_max", 16)
+        )
+    expected = feature_sigmas(**segmenter_args)
+    if len(sigmas) != len(expected) or not np.allclose(sigmas, expected):
+        raise ValueError(
+            "The classifier was trained on features at sigmas %s, but its "
+            "segmenter_args give features at sigmas %s; it must be trained again"
+            % (
+                ", ".join("%.4g" % s for s in sigmas),
+                ", ".join("%.4g" % s for s in expected),
+            )
+        )
+
+
+def _channels(img_shape, multichannel):
+    """Channels features are computed for (None for a single channel image)
+    and the number of spatial dimensions"""
+    if len(img_shape) == 3 and multichannel:
+        return list(range(img_shape[-1])), 2
+    return [None], len(img_shape)
+
+
+def feature_layout(
+    img_shape,
+    multichannel=True,
+    intensity=True,
+    edges=True,
+    texture=True,
+    sigma_min=0.5,
+    sigma_max=16,
+):
+    """Layout of the features compute_features computes for an image of shape
+    ``img_shape`` with the same options: a list with a (channel, sigma,
+    feature type, component) tuple for each feature, in the order of the
+    features. ``channel`` is None for single channel images and ``component``
+    numbers the planes of a feature type (the Hessian eigenvalues for texture).
+    Features are ordered by channel, then sigma, then feature type.
+    """
+    channels, ndim = _channels(img_shape, multichannel)
+    flags = dict(intensity=intensity, edges=edges, texture=texture)
+    return [
+        (channel, float(sigma), ft, component)
+        for channel in channels
+        for sigma in _sigmas(sigma_min, sigma_max)
+        for ft in FEATURE_TYPES
+        if flags[ft]
+        for component in range(_n_feature_planes(ft, ndim))
     ]
-    return list(itertools.chain.from_iterable(all_results))
+
+
+def feature_names(img_shape, **kwargs):
+    """Names of the features compute_features computes for an image of shape
+    ``img_shape``, e.g., "ch0_sigma0.5_texture1". The index of a name is the
+    index of the feature. ``kwargs`` are the options of feature_layout.
+    """
+    return [
+        "%ssigma%.4g_%s%s"
+        % (
+            "" if channel is None else "ch%d_" % (channel,),
+            sigma,
+            ft,
+            component if ft == "texture" else "",
+        )
+        for channel, sigma, ft, component in feature_layout(img_shape, **kwargs)
+    ]
+
+
+def _write_features(channel_img, steps, out, scale_space, blur):
+    """
+    Computes the features of one channel for the increasing sigmas of
+    ``steps``, a list of (sigma, targets) pairs, where targets is a list of
+    (feature type, index) pairs: the planes of each type are written to
+    out[index:]. Steps without targets only advance the scale space.
+    scale_space and blur are as in _scale_space.
+    """
+    sigmas = [sigma for sigma, _ in steps]
+    for (sigma, targets), (img_blur, factor) in zip(
+        steps, _scale_space(channel_img, sigmas, scale_space, blur)
+    ):
+        if len(targets) == 0:
+            continue
+        _features_blurred(
+            img_blur,
+            factor,
+            {
+                ft: out[index : index + _n_feature_planes(ft, channel_img.ndim)]
+                for ft, index in targets
+            },
+        )
+
+
+def _write_features_shm(channels_shm, channels_spec, out_shm, out_spec, task):
+    """
+    _write_features for a worker process: the channel images and the output
+    array are in shared memory blocks, given by name with their (shape, dtype).
+    """
+    c_index, steps, scale_space, blur = task
+    in_block = shared_memory.SharedMemory(name=channels_shm)
+    out_block = shared_memory.SharedMemory(name=out_shm)
+    try:
+        channels = np.ndarray(*channels_spec, buffer=in_block.buf)
+        out = np.ndarray(*out_spec, buffer=out_block.buf)
+        _write_features(channels[c_index], steps, out, scale_space, blur)
+        del channels, out
+    finally:
+        in_block.close()
+        out_block.close()
+
+
+def _run_feature_tasks(channel_imgs, tasks, out, n_jobs, backend):
+    """
+    Runs the (channel index, steps, scale space, blur) tasks of compute_features
+    (see _write_features), each writing its planes to its own slots of out, in
+    the calling thread if n_jobs is 1 or else with n_jobs threads or processes.
+    """
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    if n_jobs == 1 or len(tasks) <= 1:
+        for c_index, steps, scale_space, blur in tasks:
+            _write_features(channel_imgs[c_index], steps, out, scale_space, blur)
+    elif backend == "thread":
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [
+                executor.submit(
+                    _write_features,
+                    channel_imgs[c_index],
+                    steps,
+                    out,
+                    scale_space,
+                    blur,
+                )
+                for c_index, steps, scale_space, blur in tasks
+            ]
+            for f in futures:
+                f.result()
+    elif backend == "process":
+        in_block = shared_memory.SharedMemory(create=True, size=channel_imgs.nbytes)
+        out_block = shared_memory.SharedMemory(create=True, size=out.nbytes)
+        try:
+            shared_in = np.ndarray(
+                channel_imgs.shape, channel_imgs.dtype, buffer=in_block.buf
+            )
+            shared_in[...] = channel_imgs
+            shared_out = np.ndarray(out.shape, out.dtype, buffer=out_block.buf)
+            shared_out[...] = out
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                futures = [
+                    executor.submit(
+                        _write_features_shm,
+                        in_block.name,
+                        (channel_imgs.shape, channel_imgs.dtype),
+                        out_block.name,
+                        (out.shape, out.dtype),
+                        task,
+                    )
+                    for task in tasks
+                ]
+                for f in futures:
+                    f.result()
+            out[...] = shared_out
+            del shared_in, shared_out
+        finally:
+            in_block.close()
+            in_block.unlink()
+            out_block.close()
+            out_block.unlink()
+    else:
+        raise ValueError("Unknown backend %r" % (backend,))
 
 
 def compute_features(
@@ -78,32 +480,607 @@ def compute_features(
     texture=True,
     sigma_min=0.5,
     sigma_max=16,
+    cache=None,
+    n_jobs=1,
+    backend="thread",
+    scale_space="direct",
+    blur="exact",
+    pixel_major=False,
+    feature_subset=None,
 ):
     """Features for a single- or multi-channel image.
+    Returns a float32 array of shape (n_features,) + spatial shape, whose
+    features are described by feature_layout and feature_names. Each feature
+    is written directly to its slot of this array.
+    If ``cache`` is an LRUCache (e.g. FEATURE_CACHE), feature planes already
+    computed for the same image contents, channel, sigma and feature type are
+    taken from it instead of being recomputed (with the "cascade" and "octave"
+    scale spaces, the smaller sigmas must be the same too).
+    If ``n_jobs`` is not 1, the features of each (channel, sigma) pair are
+    computed in parallel by ``n_jobs`` workers (-1 for one per CPU), which are
+    threads if ``backend`` is "thread" or processes if it is "process". The
+    result is identical to the serial computation.
+    ``scale_space`` is "direct" (exact), "cascade" or "octave", see
+    _scale_space. With "cascade" and "octave", the sigmas of a channel are
+    computed in sequence, so only channels are computed in parallel.
+    ``blur`` is the backend of gaussian_blur: "exact", or "recursive" or "box"
+    which are faster for large sigmas but approximate.
+    If ``pixel_major`` is True, returns instead a C-contiguous float32 array
+    of shape (n_pixels, n_features) with a row per pixel in raveled order
+    (features.reshape((n_features, -1)).T for the default layout), so that
+    rows of pixels are contiguous and can be passed to the classifier without
+    the copies transposed views need.
+    If ``feature_subset`` is given, only the features with these indices (in
+    feature_layout) are computed, e.g. the features a trained classifier uses
+    (forest_utils.used_features), and the others are zeros. The planes of a
+    feature type are computed together, and sigmas without features to compute
+    are skipped.
     """
-    if img.ndim == 3 and multichannel:
-        all_results = (
-            _compute_features_gray(
-                img[..., dim],
-                intensity=intensity,
-                edges=edges,
-                texture=texture,
-                sigma_min=sigma_min,
-                sigma_max=sigma_max,
+    layout = feature_layout(
+        img.shape,
+        multichannel=multichannel,
+        intensity=intensity,
+        edges=edges,
+        texture=texture,
+        sigma_min=sigma_min,
+        sigma_max=sigma_max,
+    )
+    channels, ndim = _channels(img.shape, multichannel)
+    # computations are faster as float32
+    if channels == [None]:
+        channel_imgs = img_as_float32(img)[None]
+    else:
+        channel_imgs = np.stack([img_as_float32(img[..., c]) for c in channels])
+    digest = None if cache is None else array_digest(img)
+    # with scale spaces other than "direct", the planes of a sigma are blurred
+    # from those of the smaller sigmas, so their keys include these sigmas
+    sigmas = [round(sigma, 6) for sigma in _sigmas(sigma_min, sigma_max)]
+    if feature_subset is not None:
+        feature_subset = set(int(i) for i in feature_subset)
+        if not feature_subset <= set(range(len(layout))):
+            raise ValueError(
+                "feature_subset must be indices of the %d features" % (len(layout),)
             )
-            for dim in range(img.shape[-1])
+        if len(feature_subset) == len(layout):
+            feature_subset = None
+    # features that aren't computed are zeros
+    alloc = np.empty if feature_subset is None else np.zeros
+    if pixel_major:
+        result = alloc(channel_imgs.shape[1:] + (len(layout),), dtype=np.float32)
+        # planes are written through a (n_features,) + spatial shape view
+        out = np.moveaxis(result, -1, 0)
+        result = result.reshape((-1, len(layout)))
+    else:
+        result = out = alloc((len(layout),) + channel_imgs.shape[1:], dtype=np.float32)
+    targets = {}
+    to_cache = []
+    for index, (channel, sigma, ft, component) in enumerate(layout):
+        if component > 0:
+            continue
+        n = _n_feature_planes(ft, ndim)
+        c_index = 0 if channel is None else channel
+        targets.setdefault((c_index, sigma), [])
+        if feature_subset is not None and feature_subset.isdisjoint(
+            range(index, index + n)
+        ):
+            continue
+        if scale_space == "direct":
+            scales = round(sigma, 6)
+        else:
+            scales = tuple(s for s in sigmas if s <= round(sigma, 6))
+        key = (digest, channel, scales, ft, scale_space, blur)
+        planes = None if cache is None else cache.get(key)
+        if planes is None:
+            targets[(c_index, sigma)].append((ft, index))
+            to_cache.append((key, index, n))
+        else:
+            out[index : index + n] = planes
+    tasks = []
+    for c_index in range(len(channels)):
+        steps = [(sigma, t) for (c, sigma), t in targets.items() if c == c_index]
+        while len(steps) > 0 and len(steps[-1][1]) == 0:
+            steps.pop()
+        if scale_space == "direct":
+            tasks += [
+                (c_index, [step], scale_space, blur) for step in steps if step[1]
+            ]
+        elif len(steps) > 0:
+            # each blurred image is computed from the previous one
+            tasks.append((c_index, steps, scale_space, blur))
+    _run_feature_tasks(channel_imgs, tasks, out, n_jobs, backend)
+    if cache is not None:
+        for key, index, n in to_cache:
+            planes = tuple(np.array(out[i]) for i in range(index, index + n))
+            for plane in planes:
+                plane.flags.writeable = False
+            cache.put(key, planes)
+    return result
+
+
+def feature_halo(sigma_max):
+    """
+    Number of pixels around a region whose values affect the features in the
+    region: the radius of the largest Gaussian kernel (skimage's default
+    truncate of 4 standard deviations) plus 2 for the first and second
+    derivatives.
+    """
+    return int(4.0 * sigma_max + 0.5) + 2
+
+
+def iter_tiles(shape, tile_size, halo):
+    """
+    Splits an image with the 2d shape into tile_size x tile_size tiles.
+    Yields (tile, crop, inner) where tile are the slices of the tile in the
+    image, crop the slices of the tile grown by halo pixels (clipped to the
+    image) and inner the slices of the tile within the crop.
+    """
+    for r0 in range(0, shape[0], tile_size):
+        for c0 in range(0, shape[1], tile_size):
+            r1, c1 = min(r0 + tile_size, shape[0]), min(c0 + tile_size, shape[1])
+            tile = (slice(r0, r1), slice(c0, c1))
+            yield (tile,) + halo_crop(tile, shape, halo)
+
+
+def halo_crop(region, shape, halo):
+    """
+    Returns (crop, inner) where crop are the slices of region (a pair of
+    slices with explicit bounds of an image with the 2d shape) grown by halo
+    pixels, clipped to the image, and inner the slices of region within the
+    crop.
+    """
+    crop = tuple(
+        slice(max(s.start - halo, 0), min(s.stop + halo, n))
+        for s, n in zip(region, shape)
+    )
+    inner = tuple(
+        slice(s.start - c.start, s.stop - c.start) for s, c in zip(region, crop)
+    )
+    return crop, inner
+
+
+def roi_slices(roi, shape):
+    """
+    Slices of the region of interest roi, a (row_start, row_stop, col_start,
+    col_stop) tuple, in an image with the 2d shape. The bounds are clipped to
+    the image; raises ValueError if the clipped region is empty.
+    """
+    r0, r1, c0, c1 = [int(b) for b in roi]
+    rows = slice(max(r0, 0), min(r1, shape[0]))
+    cols = slice(max(c0, 0), min(c1, shape[1]))
+    if rows.start >= rows.stop or cols.start >= cols.stop:
+        raise ValueError("Empty region of interest %r for shape %r" % (roi, shape))
+    return rows, cols
+
+
+def compute_features_tiled(img, tile_size=512, where=None, **kwargs):
+    """
+    Yields (tile, features) for each tile of img (see iter_tiles), where
+    features are the features of the tile, equal to the corresponding part of
+    compute_features(img, **kwargs) but computed from the tile and a halo
+    around it only, so that memory is bounded by the tile size.
+    If where (a boolean array of the image's 2d shape) is given, tiles where it
+    is all False are skipped.
+    With pixel_major=True, features have the shape (tile height, tile width,
+    n_features), each pixel's features being contiguous.
+    """
+    if img.ndim != (3 if kwargs.get("multichannel", True) else 2):
+        raise ValueError("Tiled features need a 2d single- or multi-channel image")
+    halo = feature_halo(kwargs.get("sigma_max", 16))
+    for tile, crop, inner in iter_tiles(img.shape[:2], tile_size, halo):
+        if where is not None and not where[tile].any():
+            continue
+        features = compute_features(img[crop], **kwargs)
+        if kwargs.get("pixel_major", False):
+            features = features.reshape(img[crop].shape[:2] + (-1,))
+            yield tile, features[inner]
+        else:
+            yield tile, features[(slice(None),) + inner]
+
+
+def compute_features_roi(img, roi, **kwargs):
+    """
+    Features of the region of interest roi of img (see roi_slices), equal to
+    the corresponding part of compute_features(img, **kwargs) (see
+    compute_features_tiled for the conditions) but computed from the region
+    and a halo around it only. They have the pixel major layout, with the
+    shape (roi height, roi width, n_features).
+    """
+    if img.ndim != (3 if kwargs.get("multichannel", True) else 2):
+        raise ValueError("ROI features need a 2d single- or multi-channel image")
+    kwargs = dict(kwargs, pixel_major=True)
+    region = roi_slices(roi, img.shape[:2])
+    halo = feature_halo(kwargs.get("sigma_max", 16))
+    crop, inner = halo_crop(region, img.shape[:2], halo)
+    features = compute_features(img[crop], **kwargs)
+    return features.reshape(img[crop].shape[:2] + (-1,))[inner]
+
+
+def _fair_shares(sizes, budget):
+    """Splits budget into shares as equal as possible, where share i is at most
+    sizes[i]; the part of the budget a small size doesn't use goes to the
+    others."""
+    sizes = np.asarray(sizes)
+    shares = np.zeros(len(sizes), dtype=np.intp)
+    remaining = min(int(budget), int(sizes.sum()))
+    todo = list(np.argsort(sizes, kind="stable"))
+    while remaining > 0 and todo:
+        # the remainder of the division goes to the larger sizes, which come
+        # last
+        i = todo.pop(0)
+        shares[i] = min(sizes[i], remaining // (len(todo) + 1))
+        remaining -= shares[i]
+    return shares
+
+
+def _block_reduce(arr, factor, n_axes, func):
+    """func (e.g. np.mean) of the blocks of factor pixels along each of the
+    first n_axes axes of arr, padded with its edge values to a multiple of
+    factor"""
+    pad = [(0, -n % factor) for n in arr.shape[:n_axes]]
+    arr = np.pad(arr, pad + [(0, 0)] * (arr.ndim - n_axes), mode="edge")
+    shape = []
+    for n in arr.shape[:n_axes]:
+        shape += [n // factor, factor]
+    blocks = arr.reshape(tuple(shape) + arr.shape[n_axes:])
+    return func(blocks, axis=tuple(range(1, 2 * n_axes, 2)))
+
+
+def downscale_image(img, factor, multichannel=True):
+    """The float32 image img averaged over blocks of factor pixels along every
+    spatial axis"""
+    _, ndim = _channels(img.shape, multichannel)
+    return _block_reduce(img_as_float32(img), factor, ndim, np.mean)
+
+
+def downscale_labels(labels, factor):
+    """Label image with the largest label of each block of factor pixels along
+    every axis of labels, so that strokes thinner than a block are kept"""
+    return _block_reduce(labels, factor, labels.ndim, np.max)
+
+
+def upscale_labels(labels, factor, shape):
+    """Repeats each label of labels factor times along every axis and crops the
+    result to shape"""
+    for axis in range(labels.ndim):
+        labels = np.repeat(labels, factor, axis=axis)
+    return labels[tuple(slice(n) for n in shape)]
+
+
+def training_pixels(mask, downsample=10, max_pixels=None, seed=0):
+    """
+    Boolean array of the labelled pixels (mask > 0) used for training.
+    If max_pixels is None, these are every downsample-th labelled pixel in
+    raveled order.
+    Otherwise at most max_pixels pixels are selected, split as equally as
+    possible between the classes, then between the strokes (connected regions
+    of a class) of each class, so that big strokes don't swamp the training
+    set. The pixels of a stroke are a uniform random sample of it (the pixels
+    with the smallest random keys, as in reservoir sampling), with keys drawn
+    from seed so that the selection is reproducible and stable: a pixel
+    selected from a stroke stays selected as long as the stroke's share
+    doesn't shrink.
+    """
+    selected = np.zeros(mask.shape, dtype=bool)
+    if max_pixels is None:
+        selected.ravel()[np.flatnonzero(mask)[::downsample]] = True
+        return selected
+    keys = np.random.RandomState(seed).random_sample(mask.size).astype(np.float32)
+    classes, n_labelled = np.unique(mask[mask > 0], return_counts=True)
+    for label, budget in zip(classes, _fair_shares(n_labelled, max_pixels)):
+        strokes, _ = ndi.label(mask == label)
+        indices = np.flatnonzero(strokes)
+        stroke_of = strokes.ravel()[indices]
+        # pixels sorted by stroke, then by key
+        order = np.lexsort((keys[indices], stroke_of))
+        indices, stroke_of = indices[order], stroke_of[order]
+        sizes = np.bincount(stroke_of)[1:]
+        starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+        rank = np.arange(len(indices)) - starts[stroke_of - 1]
+        shares = _fair_shares(sizes, budget)
+        selected.ravel()[indices[rank < shares[stroke_of - 1]]] = True
+    return selected
+
+
+def training_counts(mask, training_labels):
+    """
+    Dictionary mapping each class of mask to its number of labelled pixels and
+    its number of pixels among training_labels (the labels of the training
+    set).
+    """
+    n_labelled = np.bincount(mask.ravel())
+    n_training = np.bincount(training_labels, minlength=len(n_labelled))
+    return {
+        int(label): (int(n_labelled[label]), int(n_training[label]))
+        for label in np.flatnonzero(n_labelled[1:]) + 1
+    }
+
+
+def compute_superpixels(img, method="slic", multichannel=True, cache=None, **kwargs):
+    """
+    Over-segmentation of the 2d image img into superpixels with the method
+    "slic" or "felzenszwalb" of skimage.segmentation, whose parameters are
+    kwargs on top of the defaults of SUPERPIXEL_METHODS. Returns an int32
+    array of the shape of the image numbering the superpixels from 0.
+    If cache is an LRUCache (e.g. SUPERPIXEL_CACHE), the superpixels of an
+    image are only computed once for the same parameters.
+    """
+    if method not in SUPERPIXEL_METHODS:
+        raise ValueError("Unknown superpixel method %r" % (method,))
+    if img.ndim != (3 if multichannel else 2):
+        raise ValueError("Superpixels need a 2d single- or multi-channel image")
+    kwargs = dict(SUPERPIXEL_METHODS[method], **kwargs)
+    if method == "slic":
+        kwargs.setdefault(
+            "n_segments", max(img.shape[0] * img.shape[1] // PIXELS_PER_SUPERPIXEL, 1)
         )
-        features = list(itertools.chain.from_iterable(all_results))
+    key = None
+    if cache is not None:
+        key = (array_digest(img), method, multichannel, tuple(sorted(kwargs.items())))
+        segments = cache.get(key)
+        if segments is not None:
+            return segments
+    channel_axis = -1 if multichannel else None
+    if method == "slic":
+        segments = segmentation.slic(img, channel_axis=channel_axis, **kwargs)
     else:
-        features = _compute_features_gray(
-            img,
-            intensity=intensity,
-            edges=edges,
-            texture=texture,
-            sigma_min=sigma_min,
-            sigma_max=sigma_max,
+        segments = segmentation.felzenszwalb(img, channel_axis=channel_axis, **kwargs)
+    # number the superpixels consecutively
+    _, segments = np.unique(segments, return_inverse=True)
+    segments = segments.reshape(img.shape[:2]).astype(np.int32)
+    segments.flags.writeable = False
+    if cache is not None:
+        cache.put(key, segments)
+    return segments
+
+
+def superpixel_features(features, segments):
+    """
+    Means over each superpixel of the pixel major features (see
+    compute_features): a float32 array with a row per superpixel of segments
+    (see compute_superpixels).
+    """
+    labels = segments.ravel()
+    n = int(labels.max()) + 1
+    # sums as the product of a sparse superpixel x pixel indicator matrix
+    indicator = sparse.csr_matrix(
+        (np.ones(labels.size), (labels, np.arange(labels.size))),
+        shape=(n, labels.size),
+    )
+    sums = indicator @ features
+    return (sums / np.bincount(labels, minlength=n)[:, None]).astype(np.float32)
+
+
+def superpixel_labels(segments, mask):
+    """
+    Label of each superpixel of segments: the most frequent label among its
+    labelled pixels (mask > 0), or 0 if it has none.
+    """
+    labelled = mask > 0
+    n = int(segments.max()) + 1
+    n_labels = int(mask.max()) + 1
+    counts = np.bincount(
+        segments[labelled].astype(np.intp) * n_labels + mask[labelled],
+        minlength=n * n_labels,
+    ).reshape((n, n_labels))
+    # labels without pixels count 0, so superpixels without labels get 0
+    return counts.argmax(axis=1).astype(mask.dtype)
+
+
+def predict_rows(clf, features, indices=None, chunk_size=PREDICT_CHUNK_SIZE):
+    """
+    Predictions of clf for the rows of the pixel major features (see
+    compute_features) given by indices (all rows if None), computed
+    chunk_size rows at a time: contiguous slices of features are passed to
+    clf as they are, rows picked by indices are gathered a chunk at a time,
+    so that memory doesn't grow with the number of pixels.
+    """
+    n = len(features) if indices is None else len(indices)
+    result = None
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        if indices is None:
+            rows = features[start:stop]
+        else:
+            rows = features[indices[start:stop]]
+        predicted = clf.predict(rows)
+        if result is None:
+            result = np.empty(n, dtype=predicted.dtype)
+        result[start:stop] = predicted
+    if result is None:
+        result = clf.predict(features[:0])
+    return result
+
+
+def _cpu_allocation(cpu_budget, n_jobs):
+    """
+    Context manager giving the n_jobs of a stage of trainable_segmentation
+    asking for n_jobs: n_jobs itself without a cpu_budget, else the number of
+    cores cpu_budget allocated, held until the end of the stage.
+    """
+    if cpu_budget is None:
+        return contextlib.nullcontext(n_jobs)
+    return cpu_budget.acquire(n_jobs)
+
+
+def _stage_n_jobs(cpu_budget, n_jobs, n_cpus):
+    """n_jobs of a computation asking for n_jobs in a stage allocated n_cpus"""
+    if cpu_budget is None:
+        return n_jobs
+    return min(n_cpus, cpu_budget.n_wanted(n_jobs))
+
+
+def _tiled_training_rows(img, selected, tile_size, **kwargs):
+    """
+    Features of the pixels where selected is True, as rows in raveled order
+    (like features[:, selected].T), computed tile by tile in the pixel major
+    layout.
+    """
+    rows = []
+    indices = []
+    for tile, features in compute_features_tiled(
+        img, tile_size=tile_size, where=selected, pixel_major=True, **kwargs
+    ):
+        sel = selected[tile]
+        rows.append(features[sel])
+        r, c = np.nonzero(sel)
+        indices.append(
+            np.ravel_multi_index((r + tile[0].start, c + tile[1].start), selected.shape)
         )
-    return np.array(features)
+    order = np.argsort(np.concatenate(indices), kind="stable")
+    return np.concatenate(rows)[order]
+
+
+def _roi_training_rows(img, selected, **kwargs):
+    """
+    Features of the pixels where selected is True, as rows in raveled order,
+    computed from the bounding box of these pixels and a halo around it.
+    """
+    r, c = np.nonzero(selected)
+    if len(r) == 0:
+        return compute_features(img[:1, :1], pixel_major=True, **kwargs)[:0]
+    roi = (r.min(), r.max() + 1, c.min(), c.max() + 1)
+    features = compute_features_roi(img, roi, **kwargs)
+    return features[r - roi[0], c - roi[2]]
+
+
+def _tiled_predict(img, clf, result, unlabelled, tile_size, **kwargs):
+    """
+    Writes the classifier's prediction for the pixels where unlabelled is True
+    (everywhere if it is None) to result, computing features tile by tile in
+    the pixel major layout.
+    """
+    for tile, features in compute_features_tiled(
+        img, tile_size=tile_size, where=unlabelled, pixel_major=True, **kwargs
+    ):
+        if unlabelled is None:
+            data = features.reshape((-1, features.shape[-1]))
+            result[tile] = predict_rows(clf, data).reshape(features.shape[:2])
+        else:
+            sel = unlabelled[tile]
+            result[tile][sel] = clf.predict(features[sel])
+
+
+class IncrementalForest:
+    """
+    Keeps the random forest and training set of the previous fit so that a mask
+    which only gained labelled pixels (e.g. the user drew one more stroke)
+    does not require training a whole new forest.
+
+    On such an update, trees_per_update new trees are trained on the
+    accumulated training set and the same number of the oldest trees are
+    dropped, so the forest keeps n_estimators trees and older trees, which
+    haven't seen the newest strokes, are gradually replaced.
+    A full refit is done instead when
+        - there is no previous fit or the features are different (key changed),
+        - labelled pixels were removed or relabelled since the previous fit,
+        - the set of classes changed,
+        - the labelled pixels added since the last full refit exceed
+          max_new_fraction of the labelled pixels of that refit (labelled
+          rather than training pixels, as training_pixels may cap the latter),
+        - max_updates incremental updates were done since the last full refit.
+    """
+
+    def __init__(
+        self,
+        n_estimators=100,
+        trees_per_update=25,
+        max_new_fraction=0.5,
+        max_updates=8,
+    ):
+        self.n_estimators = n_estimators
+        self.trees_per_update = trees_per_update
+        self.max_new_fraction = max_new_fraction
+        self.max_updates = max_updates
+        self.clf = None
+        self.key = None
+        self.mask = None
+        self.training_data = None
+        self.training_labels = None
+        self.n_full_fit = 0
+        self.n_updates = 0
+        self._lock = threading.Lock()
+
+    def _is_extension_of_previous(self, mask, key):
+        if self.clf is None or key != self.key or mask.shape != self.mask.shape:
+            return False
+        old_labelled = self.mask > 0
+        return np.array_equal(mask[old_labelled], self.mask[old_labelled])
+
+    def _full_fit(self, training_rows, mask, sampling, n_jobs):
+        from sklearn.ensemble import RandomForestClassifier
+
+        selected = training_pixels(mask, **sampling)
+        self.training_data = training_rows(selected)
+        self.training_labels = mask[selected]
+        self.clf = RandomForestClassifier(n_estimators=self.n_estimators, n_jobs=n_jobs)
+        self.clf.fit(self.training_data, self.training_labels)
+        self.n_full_fit = np.count_nonzero(mask)
+        self.n_updates = 0
+
+    def _update(self, new_data, new_labels):
+        self.training_data = np.concatenate((self.training_data, new_data))
+        self.training_labels = np.concatenate((self.training_labels, new_labels))
+        n_old = len(self.clf.estimators_)
+        self.clf.set_params(warm_start=True, n_estimators=n_old + self.trees_per_update)
+        self.clf.fit(self.training_data, self.training_labels)
+        # retire the oldest trees
+        self.clf.estimators_ = self.clf.estimators_[self.trees_per_update :]
+        self.clf.set_params(warm_start=False, n_estimators=len(self.clf.estimators_))
+        self.n_updates += 1
+
+    def fit(
+        self,
+        training_rows,
+        mask,
+        downsample=10,
+        key=None,
+        max_pixels=None,
+        seed=0,
+        n_jobs=-1,
+    ):
+        """
+        Returns a classifier trained on the labelled pixels (mask > 0).
+        training_rows(selected) must return the features of the pixels where
+        the boolean array selected is True, as rows in raveled order.
+        key identifies the image and feature parameters of these features;
+        a different key than in the previous call forces a full refit.
+        downsample, max_pixels and seed select the training pixels, see
+        training_pixels. With max_pixels, the pixels added by an update are
+        those training_pixels selects in the new mask that weren't labelled
+        before.
+        n_jobs is the number of cores the forest is trained with.
+        The returned classifier shares its trees with the forest but is not
+        modified by subsequent calls, so it can be used while they run.
+        """
+        sampling = dict(downsample=downsample, max_pixels=max_pixels, seed=seed)
+        with self._lock:
+            if not self._is_extension_of_previous(mask, key):
+                self._full_fit(training_rows, mask, sampling, n_jobs)
+            else:
+                self.clf.set_params(n_jobs=n_jobs)
+                if max_pixels is None:
+                    new_mask = np.where(self.mask == 0, mask, 0)
+                    new = training_pixels(new_mask, **sampling)
+                else:
+                    new = training_pixels(mask, **sampling) & (self.mask == 0)
+                new_labels = mask[new]
+                n_added = np.count_nonzero(mask) - self.n_full_fit
+                if len(new_labels) == 0:
+                    pass
+                elif (
+                    set(np.unique(new_labels)) <= set(self.clf.classes_)
+                    and n_added <= self.max_new_fraction * self.n_full_fit
+                    and self.n_updates < self.max_updates
+                ):
+                    self._update(training_rows(new), new_labels)
+                else:
+                    self._full_fit(training_rows, mask, sampling, n_jobs)
+            self.key = key
+            self.mask = mask.copy()
+            # updates extend and trim the list of trees of self.clf in place
+            clf = copy.copy(self.clf)
+            clf.estimators_ = list(self.clf.estimators_)
+            return clf
 
 
 def trainable_segmentation(
@@ -116,47 +1093,312 @@ def trainable_segmentation(
     sigma_min=0.5,
     sigma_max=16,
     downsample=10,
+    max_training_pixels=None,
+    training_seed=0,
+    n_estimators=100,
     clf=None,
-    verbose=False
+    verbose=False,
+    feature_cache=None,
+    incremental_forest=None,
+    tile_size=None,
+    feature_n_jobs=1,
+    feature_backend="thread",
+    scale_space="direct",
+    blur="exact",
+    checkpoint=None,
+    resolution_level=0,
+    superpixels=None,
+    superpixel_args=None,
+    superpixel_cache=None,
+    roi=None,
+    n_jobs=-1,
+    cpu_budget=None,
 ):
     """
     Segmentation using labeled parts of the image and a random forest classifier.
+    The classifier is trained on the pixels training_pixels selects with
+    downsample, max_training_pixels and training_seed: by default every
+    downsample-th labelled pixel, or, if max_training_pixels is given, at
+    most that many pixels balanced between classes and strokes.
+    n_estimators is the number of trees of the classifier (unless it is an
+    incremental_forest).
+    If clf is given, it classifies the pixels instead of a trained forest. It
+    can be a scikit-learn classifier or a forest_utils.ForestModel loaded
+    from an export; scikit-learn is only imported to train a forest. The
+    features the pixels are classified with are computed with the
+    feature_subset of compute_features set to the features the forest uses
+    (forest_utils.used_features), so with a given clf, or with roi or
+    tile_size, unused features and sigmas are skipped; the other features are
+    zeros, which the forest ignores. verbose reports the reduction.
+    feature_cache is passed as the cache argument of compute_features.
+    If incremental_forest (an IncrementalForest) is given and clf is None, the
+    classifier is obtained by updating it with the mask instead of training a
+    new forest.
+    If tile_size is given, features are computed and pixels classified
+    tile_size x tile_size tiles at a time (see compute_features_tiled), so that
+    memory use is bounded by the tile size instead of the image size. The
+    features are the same as when computed on the whole image.
+    feature_n_jobs and feature_backend are the n_jobs and backend arguments of
+    compute_features. scale_space is passed to compute_features; tiles are only
+    identical to the whole-image features with the "direct" scale space.
+    blur is passed to compute_features: "exact" for exported segmentations,
+    "recursive" or "box" for faster previews with large sigmas.
+    If given, checkpoint is called without arguments after computing the
+    features and after fitting the classifier, so that a job running the
+    segmentation can be cancelled between these stages by raising an
+    exception from it.
+    If resolution_level is n > 0, the segmentation is computed on img
+    downscaled by 2 ** n along each spatial axis (see downscale_image and
+    downscale_labels), with sigma_min and sigma_max divided by 2 ** n so that
+    the features cover the same parts of the image, then upscaled to the
+    image's size. This is about 4 ** n times faster and gives a coarse
+    preview of the segmentation. Labelled pixels keep their label. clf, if
+    given, must have been trained at the same resolution level. With a
+    feature_cache, the features of the downscaled image are reused by later
+    calls at the same level.
+    If superpixels is "slic" or "felzenszwalb", the image is over-segmented
+    by compute_superpixels (with the parameters superpixel_args and the cache
+    superpixel_cache) and the classifier is trained on and predicts
+    superpixels instead of pixels: their features are the means of the
+    features of their pixels and the label of a superpixel is the most
+    frequent label of its labelled pixels (superpixel_labels). The
+    predictions are then broadcast to the pixels. This is not available with
+    tile_size, downsample is ignored and max_training_pixels counts
+    superpixels.
+    If roi, a (row_start, row_stop, col_start, col_stop) region of interest
+    (see roi_slices), is given, only its pixels are predicted and the result
+    is the label map of the region, e.g. the part of the image in view. Its
+    features are computed from the region and a halo around it
+    (compute_features_roi), and the training features from the bounding box
+    of the training pixels and a halo around it (or tile by tile if tile_size
+    is given), so that only the features of the parts of the image that are
+    used are computed. This is not available with superpixels or
+    resolution_level.
+    n_jobs is the number of cores of the random forest (-1 for all of them).
+    If cpu_budget (a job_utils.CPUBudget) is given, the features, the fit and
+    the prediction each run with the cores the budget allocates them, at most
+    feature_n_jobs for the features and n_jobs for the fit and prediction
+    (which sets the n_jobs of clf), so that concurrent segmentations share
+    the cores instead of oversubscribing them.
     """
-    t1 = time()
-    features = compute_features(
-        img,
+    if roi is not None and (superpixels is not None or resolution_level > 0):
+        raise ValueError("roi can't be used with superpixels or resolution_level")
+    if resolution_level > 0:
+        factor = 2 ** resolution_level
+        result, clf = trainable_segmentation(
+            downscale_image(img, factor, multichannel=multichannel),
+            mask=None if mask is None else downscale_labels(mask, factor),
+            multichannel=multichannel,
+            intensity=intensity,
+            edges=edges,
+            texture=texture,
+            sigma_min=sigma_min / factor,
+            sigma_max=sigma_max / factor,
+            downsample=downsample,
+            max_training_pixels=max_training_pixels,
+            training_seed=training_seed,
+            n_estimators=n_estimators,
+            clf=clf,
+            verbose=verbose,
+            feature_cache=feature_cache,
+            incremental_forest=incremental_forest,
+            tile_size=tile_size,
+            feature_n_jobs=feature_n_jobs,
+            feature_backend=feature_backend,
+            scale_space=scale_space,
+            blur=blur,
+            checkpoint=checkpoint,
+            superpixels=superpixels,
+            superpixel_args=superpixel_args,
+            superpixel_cache=superpixel_cache,
+            n_jobs=n_jobs,
+            cpu_budget=cpu_budget,
+        )
+        _, ndim = _channels(img.shape, multichannel)
+        result = upscale_labels(result, factor, img.shape[:ndim])
+        if mask is not None:
+            result = np.where(mask > 0, mask, result)
+        return result, clf
+    feature_args = dict(
         multichannel=multichannel,
         intensity=intensity,
         edges=edges,
         texture=texture,
         sigma_min=sigma_min,
         sigma_max=sigma_max,
+        cache=feature_cache,
+        n_jobs=feature_n_jobs,
+        backend=feature_backend,
+        scale_space=scale_space,
+        blur=blur,
     )
+    if clf is not None:
+        # only the features the classifier splits on are computed
+        feature_args["feature_subset"] = used_features(clf)
+    if superpixels is not None and tile_size is not None:
+        raise ValueError("Superpixels can't be used with tiles")
+    t1 = time()
+    # the labels the classifier is trained on, one per row of features
+    train_mask = mask
+    if roi is not None:
+        region = roi_slices(roi, img.shape[:2])
+
+        def training_rows(selected):
+            if tile_size is not None:
+                return _tiled_training_rows(img, selected, tile_size, **feature_args)
+            return _roi_training_rows(img, selected, **feature_args)
+
+    elif tile_size is None:
+        with _cpu_allocation(cpu_budget, feature_n_jobs) as n_cpus:
+            feature_args["n_jobs"] = _stage_n_jobs(cpu_budget, feature_n_jobs, n_cpus)
+            # a row per pixel, so that the classifier gets contiguous rows
+            features = compute_features(img, pixel_major=True, **feature_args)
+            if superpixels is not None:
+                segments = compute_superpixels(
+                    img,
+                    superpixels,
+                    multichannel=multichannel,
+                    cache=superpixel_cache,
+                    **(superpixel_args or {})
+                )
+                # a row per superpixel
+                features = superpixel_features(features, segments)
+                if mask is not None:
+                    train_mask = superpixel_labels(segments, mask)
+                # superpixels already average many pixels
+                downsample = 1
+
+        def training_rows(selected):
+            return features[np.flatnonzero(selected)]
+
+    else:
+
+        def training_rows(selected):
+            return _tiled_training_rows(img, selected, tile_size, **feature_args)
+
     t2 = time()
+    if checkpoint is not None:
+        checkpoint()
     if clf is None:
         if mask is None:
             raise ValueError("If no classifier clf is passed, you must specify a mask.")
-        training_data = features[:, mask > 0].T
-        training_labels = mask[mask > 0].ravel()
-        data = features[:, mask == 0].T
         t3 = time()
-        clf = RandomForestClassifier(n_estimators=100, n_jobs=-1)
-        clf.fit(training_data[::downsample], training_labels[::downsample])
-        result = np.copy(mask)
+        with _cpu_allocation(cpu_budget, n_jobs) as n_cpus:
+            feature_args["n_jobs"] = _stage_n_jobs(cpu_budget, feature_n_jobs, n_cpus)
+            if incremental_forest is not None:
+                key = (
+                    array_digest(img),
+                    multichannel,
+                    intensity,
+                    edges,
+                    texture,
+                    sigma_min,
+                    sigma_max,
+                    scale_space,
+                    blur,
+                    max_training_pixels,
+                    training_seed,
+                    superpixels,
+                    superpixel_args and sorted(superpixel_args.items()),
+                )
+                clf = incremental_forest.fit(
+                    training_rows,
+                    train_mask,
+                    downsample=downsample,
+                    key=key,
+                    max_pixels=max_training_pixels,
+                    seed=training_seed,
+                    n_jobs=n_cpus,
+                )
+                training_labels = incremental_forest.training_labels
+            else:
+                from sklearn.ensemble import RandomForestClassifier
+
+                selected = training_pixels(
+                    train_mask,
+                    downsample=downsample,
+                    max_pixels=max_training_pixels,
+                    seed=training_seed,
+                )
+                training_labels = train_mask[selected]
+                clf = RandomForestClassifier(n_estimators=n_estimators, n_jobs=n_cpus)
+                clf.fit(training_rows(selected), training_labels)
     else:
-        # we have to flatten all but the first dimension of features
-        data = features.reshape((features.shape[0], np.product(features.shape[1:]))).T
         t3 = time()
+        training_labels = None
+    if checkpoint is not None:
+        checkpoint()
     t4 = time()
-    labels = clf.predict(data)
-    if mask is None:
-        result = labels.reshape(img.shape[:2])
-    else:
-        result[mask == 0] = labels
+    with _cpu_allocation(cpu_budget, n_jobs) as n_cpus:
+        feature_args["n_jobs"] = _stage_n_jobs(cpu_budget, feature_n_jobs, n_cpus)
+        if cpu_budget is not None and hasattr(clf, "set_params"):
+            clf.set_params(n_jobs=n_cpus)
+        # features computed from here on (by roi or tiles) are only used by clf
+        feature_args["feature_subset"] = used_features(clf)
+        if mask is not None:
+            result = np.copy(mask)
+        if roi is not None:
+            features = compute_features_roi(img, roi, **feature_args)
+            roi_shape = features.shape[:2]
+            features = features.reshape((-1, features.shape[-1]))
+            if mask is None:
+                result = predict_rows(clf, features).reshape(roi_shape)
+            else:
+                result = mask[region].copy()
+                unlabelled = result == 0
+                result[unlabelled] = predict_rows(
+                    clf, features, np.flatnonzero(unlabelled)
+                )
+        elif tile_size is not None:
+            if mask is None:
+                result = np.empty(img.shape[:2], dtype=clf.classes_.dtype)
+                _tiled_predict(img, clf, result, None, tile_size, **feature_args)
+            else:
+                unlabelled = mask == 0
+                _tiled_predict(img, clf, result, unlabelled, tile_size, **feature_args)
+        elif superpixels is not None:
+            result = predict_rows(clf, features)[segments]
+            if mask is not None:
+                result = np.where(mask > 0, mask, result)
+        elif mask is None:
+            result = predict_rows(clf, features).reshape(img.shape[:2])
+        else:
+            unlabelled = mask == 0
+            result[unlabelled] = predict_rows(
+                clf, features, np.flatnonzero(unlabelled)
+            )
     t5 = time()
     if verbose:
         print("trainable_segmentation timings:")
         print("\tcompute features", t2 - t1)
         print("\tfit", t4 - t3)
         print("\tpredict", t5 - t4)
+        if feature_args["feature_subset"] is not None:
+            layout = feature_layout(
+                img.shape,
+                multichannel=multichannel,
+                intensity=intensity,
+                edges=edges,
+                texture=texture,
+                sigma_min=sigma_min,
+                sigma_max=sigma_max,
+            )
+            used = [layout[i] for i in feature_args["feature_subset"]]
+            print(
+                "features used by the classifier: %d of %d, at %d of %d "
+                "(channel, sigma) pairs"
+                % (
+                    len(used),
+                    len(layout),
+                    len(set(f[:2] for f in used)),
+                    len(set(f[:2] for f in layout)),
+                )
+            )
+        if training_labels is not None:
+            print(
+                "training %s (labelled, used) per class:"
+                % ("pixels" if superpixels is None else "superpixels",)
+            )
+            for label, counts in training_counts(train_mask, training_labels).items():
+                print("\t%d: %d, %d" % ((label,) + counts))
     return result, clf
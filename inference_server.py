@@ -0,0 +1,239 @@
+__doc__ = """
+Resident server classifying images with the classifiers downloaded from the
+ml_image_segmentation.py webapp, so that classifying an image doesn't pay
+for starting Python, importing the libraries and loading the classifier.
+Start it like so:
+
+    PORT=8051 python inference_server.py
+
+or with gunicorn and threads (requests of a process are batched together):
+
+    gunicorn --threads 8 -b 127.0.0.1:8051 inference_server:app
+
+and classify images by posting to /segment the path of the classifier (a
+classifier.npz file on the server's machine) with the image, either as an
+uploaded file or as a path on the server's machine:
+
+    curl -F classifier=path/to/classifier.npz -F image=@path/to/image.png \\
+        http://127.0.0.1:8051/segment > classified.png
+    curl -F classifier=path/to/classifier.npz -F image_path=path/to/image.png \\
+        -F out_img=path/to/classified.png -F out_blend=path/to/blended.png \\
+        http://127.0.0.1:8051/segment
+
+Without out_img, the response is the classified image as a PNG. With it,
+the classified image (and the blended image if out_blend is given) are
+written to these paths and the response is JSON.
+
+The paths are relative to the directories CLASSIFIER_DIR, IMAGE_DIR and
+OUTPUT_DIR (by default the current directory), which are set by the
+environment variables of these names, and paths outside of them are refused.
+Classifiers must be .npz files, which are loaded without unpickling:
+classifier.json files of older versions of the webapp, pickled scikit-learn
+forests, can run arbitrary code and aren't accepted. roi=row_start,row_stop,
+col_start,col_stop classifies only a region of the image (see
+use_ml_image_segmentation_classifier.py).
+
+The last MAX_MODELS classifiers used stay loaded, keyed by the digest of
+their file, and the predictions of concurrent requests for the same
+classifier are computed in a single call (see job_utils.MicroBatcher).
+GET /stats returns the hits and misses of the classifiers and the batches.
+
+"""
+
+import hashlib
+import io
+import os
+import threading
+import time
+import flask
+import numpy as np
+import skimage.io
+import plot_common
+from cache_utils import LRUCache
+from forest_utils import load_forest, used_features
+from image_segmentation import check_sigmas
+from job_utils import MicroBatcher
+from use_ml_image_segmentation_classifier import (
+    IMG_ENDINGS,
+    classify_img,
+    parse_roi,
+    save_classified_img,
+)
+
+# classifiers kept loaded, the least recently used being dropped
+MAX_MODELS = 8
+
+# seconds the first request of a batch waits for concurrent requests for the
+# same classifier, and maximum number of pixels of a batch
+BATCH_DELAY = 0.005
+BATCH_MAX_ROWS = 2 ** 20
+
+# directories of the classifiers, of the images given by path and of the
+# outputs, which the paths of requests can't leave
+CLASSIFIER_DIR = os.path.realpath(os.environ.get("CLASSIFIER_DIR", "."))
+IMAGE_DIR = os.path.realpath(os.environ.get("IMAGE_DIR", "."))
+OUTPUT_DIR = os.path.realpath(os.environ.get("OUTPUT_DIR", "."))
+
+
+class BatchedClassifier:
+    """
+    Classifier predicting with clf in batches with the concurrent calls of
+    other threads (see job_utils.MicroBatcher).
+    """
+
+    def __init__(self, clf, max_delay=BATCH_DELAY, max_rows=BATCH_MAX_ROWS):
+        self.clf = clf
+        self.classes_ = clf.classes_
+        self.n_features_in_ = clf.n_features_in_
+        self.batcher = MicroBatcher(clf.predict, max_delay, max_rows)
+
+    def used_features(self):
+        return used_features(self.clf)
+
+    def predict(self, X):
+        return self.batcher(X)
+
+
+class ModelCache:
+    """
+    Classifiers loaded from their .npz files with forest_utils.load_forest, as
+    BatchedClassifier, kept in an LRUCache of max_models entries keyed by the
+    digest of the contents of the file, so that a changed file is reloaded
+    and copies of a file share their classifier.
+    """
+
+    def __init__(self, max_models=MAX_MODELS):
+        # the models' sizes aren't counted, only their number
+        self.models = LRUCache(max_bytes=np.inf, max_entries=max_models)
+        # digests of (path, modification time, size), not to hash the files
+        # of each request
+        self._digests = LRUCache(max_bytes=np.inf, max_entries=64 * max_models)
+        self._lock = threading.Lock()
+
+    def digest(self, path):
+        st = os.stat(path)
+        key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+        digest = self._digests.get(key)
+        if digest is None:
+            h = hashlib.sha1()
+            with open(path, "rb") as fd:
+                for block in iter(lambda: fd.read(2 ** 20), b""):
+                    h.update(block)
+            digest = h.hexdigest()
+            self._digests.put(key, digest)
+        return digest
+
+    def get(self, path):
+        """Returns (clf, segmenter_args, label_to_colors_args) of the file path"""
+        digest = self.digest(path)
+        model = self.models.get(digest)
+        if model is None:
+            # loaded once even if concurrent requests need it
+            with self._lock:
+                model = self.models.get(digest)
+                if model is None:
+                    clf, metadata = load_forest(path)
+                    check_sigmas(metadata["segmenter_args"], metadata.get("sigmas"))
+                    model = (
+                        BatchedClassifier(clf),
+                        metadata["segmenter_args"],
+                        metadata["label_to_colors_args"],
+                    )
+                    self.models.put(digest, model)
+        return model
+
+    def stats(self):
+        models = self.models.items()
+        return {
+            "n_models": len(models),
+            "hits": self.models.hits,
+            "misses": self.models.misses,
+            "batches": {
+                digest: {
+                    "n_calls": clf.batcher.n_calls,
+                    "n_batches": clf.batcher.n_batches,
+                    "max_batch_calls": clf.batcher.max_batch_calls,
+                }
+                for digest, (clf, _, _) in models
+            },
+        }
+
+
+MODELS = ModelCache()
+
+app = flask.Flask(__name__)
+
+
+def resolve_path(path, directory):
+    """
+    Real path of path, relative to directory, aborting the request if it is
+    outside of directory (e.g. through .. or a symbolic link)
+    """
+    real = os.path.realpath(os.path.join(directory, path))
+    if os.path.commonpath([real, directory]) != directory:
+        flask.abort(403, "%s is outside of the allowed directory" % (path,))
+    return real
+
+
+def output_path(path):
+    """resolve_path of an output path in OUTPUT_DIR, which must be an image"""
+    if not path.lower().endswith(IMG_ENDINGS):
+        flask.abort(400, "%s is not an image path" % (path,))
+    return resolve_path(path, OUTPUT_DIR)
+
+
+@app.route("/segment", methods=["POST"])
+def segment():
+    form = flask.request.form
+    if "classifier" not in form:
+        flask.abort(400, "classifier is required")
+    if not form["classifier"].endswith(".npz"):
+        flask.abort(400, "classifier must be a .npz file")
+    out_img = output_path(form["out_img"]) if "out_img" in form else None
+    out_blend = output_path(form["out_blend"]) if "out_blend" in form else None
+    try:
+        clf, segmenter_args, label_to_colors_args = MODELS.get(
+            resolve_path(form["classifier"], CLASSIFIER_DIR)
+        )
+    except FileNotFoundError:
+        flask.abort(404, "No classifier %s" % (form["classifier"],))
+    except ValueError as e:
+        # e.g. a classifier trained on features at other sigmas
+        flask.abort(400, str(e))
+    if "image" in flask.request.files:
+        img = skimage.io.imread(io.BytesIO(flask.request.files["image"].read()))
+    elif "image_path" in form:
+        img = skimage.io.imread(resolve_path(form["image_path"], IMAGE_DIR))
+    else:
+        flask.abort(400, "image or image_path is required")
+    try:
+        roi = parse_roi(form["roi"]) if "roi" in form else None
+    except ValueError as e:
+        flask.abort(400, str(e))
+    t = time.time()
+    color_seg = classify_img(clf, segmenter_args, label_to_colors_args, img, roi=roi)
+    if out_img is not None:
+        save_classified_img(img, color_seg, out_img, out_blend, roi=roi)
+        return flask.jsonify(
+            {
+                "out_img": form["out_img"],
+                "out_blend": form.get("out_blend"),
+                "seconds": time.time() - t,
+            }
+        )
+    pngbytes = io.BytesIO()
+    plot_common.img_array_to_pil_image(color_seg).save(pngbytes, format="png")
+    return flask.Response(pngbytes.getvalue(), mimetype="image/png")
+
+
+@app.route("/stats")
+def stats():
+    return flask.jsonify(MODELS.stats())
+
+
+if __name__ == "__main__":
+    app.run(
+        host=os.environ.get("HOST", "127.0.0.1"),
+        port=int(os.environ.get("PORT", 8051)),
+        threaded=True,
+    )
@@ -0,0 +1,481 @@
+import fcntl
+import itertools
+import os
+import queue
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+
+
+class JobCancelled(Exception):
+    """Raised by a job's checkpoint when the job became stale"""
+
+
+class LatestJobRunner:
+    """
+    Runs jobs in a pool of max_workers background threads, keeping only the
+    latest job of each session: submitting a job makes the previous jobs of
+    the same session stale. A stale job that hasn't started is skipped and a
+    running one stops at its next checkpoint.
+
+    Jobs are cancelled cooperatively. A job is a function taking a checkpoint
+    keyword argument, a function it should call between the stages of its
+    work, which raises JobCancelled if the job is stale.
+    """
+
+    def __init__(self, max_workers=1):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._latest = {}
+        self._lock = threading.Lock()
+        self.n_submitted = 0
+        self.n_cancelled = 0
+
+    def _checkpoint(self, session, job_id, is_stale):
+        with self._lock:
+            stale = self._latest.get(session) != job_id
+        if stale or (is_stale is not None and is_stale()):
+            raise JobCancelled()
+
+    def _run(self, session, job_id, is_stale, fn, args, kwargs):
+        def checkpoint():
+            self._checkpoint(session, job_id, is_stale)
+
+        try:
+            checkpoint()
+            return fn(*args, checkpoint=checkpoint, **kwargs)
+        except JobCancelled:
+            with self._lock:
+                self.n_cancelled += 1
+            return None
+        finally:
+            with self._lock:
+                if self._latest.get(session) == job_id:
+                    del self._latest[session]
+
+    def submit(self, session, fn, *args, is_stale=None, **kwargs):
+        """
+        Submits fn(*args, checkpoint=checkpoint, **kwargs) as the latest job of
+        session and returns its Future, whose result is None if the job was
+        cancelled. If given, is_stale is also called at each checkpoint, the
+        job being cancelled if it returns True (e.g. to cancel jobs that were
+        superseded in another process).
+        """
+        with self._lock:
+            self.n_submitted += 1
+            job_id = self.n_submitted
+            self._latest[session] = job_id
+        return self._executor.submit(
+            self._run, session, job_id, is_stale, fn, args, kwargs
+        )
+
+    def cancel(self, session):
+        """Makes the jobs of session stale"""
+        with self._lock:
+            self._latest.pop(session, None)
+
+
+class CPUAllocation:
+    """
+    CPU tokens held by a computation (see CPUBudget.acquire), released by
+    release() or at the end of a with block. n_cpus is the number of cores the
+    computation may use.
+    """
+
+    def __init__(self, budget, fds):
+        self.budget = budget
+        self.n_cpus = len(fds)
+        self._fds = fds
+
+    def release(self):
+        for fd in self._fds:
+            fd.close()
+        self._fds = []
+        self.budget._released(self.n_cpus)
+
+    def __enter__(self):
+        return self.n_cpus
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class CPUBudget:
+    """
+    Pool of n_cpus (by default the number of CPUs) tokens shared by the
+    threads and processes (e.g. gunicorn workers) using the same directory,
+    so that concurrent computations share the machine's cores instead of each
+    starting a thread per core.
+    A token is a file of directory held with an exclusive flock, so the
+    tokens of a process that dies are released with its files. A computation
+    waiting for tokens holds the flock of a "wait-" file, which gives the
+    queue depth across processes.
+    """
+
+    _TOKEN_PREFIX = "cpu-"
+    _WAIT_PREFIX = "wait-"
+
+    def __init__(self, directory, n_cpus=None, poll_interval=0.01):
+        self.directory = directory
+        self.n_cpus = n_cpus or os.cpu_count()
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._waiter_ids = itertools.count()
+        # metrics of this process
+        self.n_acquired = 0
+        self.n_waited = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.n_held = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def n_wanted(self, n_jobs):
+        """Number of cores n_jobs asks for, negative values counting from
+        n_cpus like joblib's (-1 is all of them)"""
+        if n_jobs < 0:
+            n_jobs = self.n_cpus + 1 + n_jobs
+        return min(max(n_jobs, 1), self.n_cpus)
+
+    def _try_lock(self, name):
+        fd = open(os.path.join(self.directory, name), "a")
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            fd.close()
+            return None
+        return fd
+
+    def _create_locked(self, name):
+        """Creates the file name of directory locked: the file is locked under a
+        temporary name and then renamed, so that queue_depth never sees it
+        unlocked (and takes it for a stale file)"""
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=self.directory)
+        fd = os.fdopen(fd, "a")
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.rename(tmp_path, os.path.join(self.directory, name))
+        except BaseException:
+            fd.close()
+            os.unlink(tmp_path)
+            raise
+        return fd
+
+    def _take(self, wanted, n_waiting):
+        """Locks up to wanted free tokens, keeping a share of them for the
+        n_waiting other computations"""
+        start = random.randrange(self.n_cpus)
+        fds = []
+        for i in range(self.n_cpus):
+            if len(fds) == wanted:
+                break
+            fd = self._try_lock(self._TOKEN_PREFIX + str((start + i) % self.n_cpus))
+            if fd is not None:
+                fds.append(fd)
+        keep = max(len(fds) // (1 + n_waiting), 1) if fds else 0
+        for fd in fds[keep:]:
+            fd.close()
+        return fds[:keep]
+
+    def queue_depth(self):
+        """Number of computations waiting for tokens, in all processes"""
+        depth = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.startswith(self._WAIT_PREFIX):
+                continue
+            try:
+                fd = self._try_lock(entry.name)
+            except FileNotFoundError:
+                continue
+            if fd is None:
+                depth += 1
+            else:
+                # left by a process that died while waiting
+                fd.close()
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+        return depth
+
+    def acquire(self, n_jobs=-1):
+        """
+        Waits until at least one token is free and returns a CPUAllocation of
+        up to n_wanted(n_jobs) free tokens, fewer if other computations are
+        waiting so that they get a share of the free tokens.
+        """
+        wanted = self.n_wanted(n_jobs)
+        t = time.time()
+        fds = self._take(wanted, self.queue_depth())
+        waited = not fds
+        if waited:
+            name = "%s%d-%d" % (self._WAIT_PREFIX, os.getpid(), next(self._waiter_ids))
+            waiting = self._create_locked(name)
+            try:
+                while not fds:
+                    time.sleep(self.poll_interval)
+                    fds = self._take(wanted, self.queue_depth() - 1)
+            finally:
+                try:
+                    os.unlink(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+                waiting.close()
+        wait = time.time() - t
+        with self._lock:
+            self.n_acquired += 1
+            self.n_held += len(fds)
+            self.n_waited += waited
+            self.wait_time += wait
+            self.max_wait_time = max(self.max_wait_time, wait)
+        return CPUAllocation(self, fds)
+
+    def _released(self, n_cpus):
+        with self._lock:
+            self.n_held -= n_cpus
+
+    def stats(self):
+        """Metrics of the budget: queue depth and free tokens across processes,
+        and the allocations and wait times of this process"""
+        # tokens are locked one at a time, not to hold all of them at once
+        # while acquire is called
+        n_free = 0
+        for i in range(self.n_cpus):
+            fd = self._try_lock(self._TOKEN_PREFIX + str(i))
+            if fd is not None:
+                n_free += 1
+                fd.close()
+        queue_depth = self.queue_depth()
+        with self._lock:
+            return {
+                "n_cpus": self.n_cpus,
+                "n_free": n_free,
+                "queue_depth": queue_depth,
+                "n_held": self.n_held,
+                "n_acquired": self.n_acquired,
+                "n_waited": self.n_waited,
+                "mean_wait_time": self.wait_time / max(self.n_acquired, 1),
+                "max_wait_time": self.max_wait_time,
+            }
+
+
+class Pipeline:
+    """
+    Streams items through stages, a list of (name, fn, n_threads), each stage
+    running fn on the results of the previous one in its own n_threads
+    threads, so that the stages overlap (e.g. reading images while others are
+    classified). Stages are connected by queues of at most queue_size items,
+    so a stage that is ahead of the next one blocks (backpressure) instead of
+    accumulating results in memory.
+
+    Each stage counts the items it processed and failed, the time its
+    threads spent in fn (busy), waiting for items of the previous stage
+    (starved) and waiting for room in the queue of the next stage (blocked),
+    see stats.
+    """
+
+    # seconds between the checks of a blocked thread for a stopped run
+    _POLL_INTERVAL = 0.1
+
+    def __init__(self, stages, queue_size=2):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.wall_time = 0.0
+        self._lock = threading.Lock()
+        self._stats = {
+            name: dict(
+                n_threads=n_threads,
+                n_items=0,
+                n_failed=0,
+                busy_time=0.0,
+                starved_time=0.0,
+                blocked_time=0.0,
+            )
+            for name, _, n_threads in stages
+        }
+
+    def _put(self, q, x, stop):
+        """Puts x in q, returns False if the run stopped first"""
+        while not stop.is_set():
+            try:
+                q.put(x, timeout=self._POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q, stop):
+        """Next x of q, None if the run stopped first"""
+        while not stop.is_set():
+            try:
+                return q.get(timeout=self._POLL_INTERVAL)
+            except queue.Empty:
+                pass
+        return None
+
+    def _feed(self, items, q, done, stop, errors):
+        """Puts the items in q, then done even if iterating items raised (the
+        error is appended to errors)"""
+        try:
+            for item in items:
+                if not self._put(q, (item, item, None), stop):
+                    return
+        except Exception as e:
+            errors.append(e)
+        finally:
+            self._put(q, done, stop)
+
+    def _work(self, name, fn, q_in, q_out, done, remaining, stop):
+        stats = self._stats[name]
+        while True:
+            t0 = time.time()
+            x = self._get(q_in, stop)
+            t1 = time.time()
+            if x is None:
+                return
+            if x is done:
+                with self._lock:
+                    stats["starved_time"] += t1 - t0
+                    remaining[name] -= 1
+                    last = remaining[name] == 0
+                # the other threads of the stage stop too, and the last one
+                # tells the next stage
+                self._put(q_out if last else q_in, done, stop)
+                return
+            item, value, error = x
+            # items that failed in a previous stage are passed on
+            processed = error is None
+            if processed:
+                try:
+                    value = fn(value)
+                except Exception as e:
+                    value, error = None, e
+            t2 = time.time()
+            if not self._put(q_out, (item, value, error), stop):
+                return
+            t3 = time.time()
+            with self._lock:
+                stats["n_items"] += processed
+                stats["n_failed"] += processed and error is not None
+                stats["starved_time"] += t1 - t0
+                stats["busy_time"] += t2 - t1
+                stats["blocked_time"] += t3 - t2
+
+    def run(self, items):
+        """
+        Yields (item, result, error) for each of items when it went through
+        the stages, in the order they finish: result is the value returned by
+        the last stage, or None if a stage raised error (an Exception), in
+        which case the item skipped the next stages. Closing the generator
+        stops the stages. If iterating items raises, the items before go
+        through the stages, then run raises the error.
+        """
+        done = object()
+        stop = threading.Event()
+        feed_errors = []
+        queues = [queue.Queue(self.queue_size) for _ in range(len(self.stages) + 1)]
+        remaining = {name: n_threads for name, _, n_threads in self.stages}
+        threads = [
+            threading.Thread(
+                target=self._feed,
+                args=(items, queues[0], done, stop, feed_errors),
+                daemon=True,
+            )
+        ]
+        for i, (name, fn, n_threads) in enumerate(self.stages):
+            threads += [
+                threading.Thread(
+                    target=self._work,
+                    args=(name, fn, queues[i], queues[i + 1], done, remaining, stop),
+                    daemon=True,
+                )
+                for _ in range(n_threads)
+            ]
+        t = time.time()
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                x = queues[-1].get()
+                if x is done:
+                    break
+                yield x
+            if feed_errors:
+                raise feed_errors[0]
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            self.wall_time += time.time() - t
+
+    def stats(self):
+        """Metrics of the stages (see the class docstring) over the runs, with
+        the items each stage processed per second of the runs"""
+        with self._lock:
+            return {
+                name: dict(
+                    stats,
+                    items_per_second=stats["n_items"] / max(self.wall_time, 1e-9),
+                )
+                for name, stats in self._stats.items()
+            }
+
+
+class MicroBatcher:
+    """
+    Gathers the arrays that concurrent threads pass to it and calls fn once
+    on their concatenation, e.g. to classify the pixels of concurrent
+    requests with one predict call. fn must return an array with a row per
+    row of its argument, which is split back between the callers.
+
+    The first caller of a batch waits up to max_delay seconds for others to
+    join it, or until the batch has max_rows rows, and then runs fn in its
+    thread while the next batch gathers. n_calls and n_batches count the
+    calls and the batches they were gathered in.
+    """
+
+    def __init__(self, fn, max_delay=0.005, max_rows=2 ** 20):
+        self.fn = fn
+        self.max_delay = max_delay
+        self.max_rows = max_rows
+        self.n_calls = 0
+        self.n_batches = 0
+        self.max_batch_calls = 0
+        self._cond = threading.Condition()
+        self._pending = []
+        self._n_rows = 0
+
+    def __call__(self, rows):
+        """fn(rows), computed in a batch with the rows of concurrent calls"""
+        future = Future()
+        with self._cond:
+            self.n_calls += 1
+            self._pending.append((rows, future))
+            self._n_rows += len(rows)
+            leader = len(self._pending) == 1
+            if leader:
+                deadline = time.time() + self.max_delay
+                while self._n_rows < self.max_rows:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending
+                self._pending = []
+                self._n_rows = 0
+                self.n_batches += 1
+                self.max_batch_calls = max(self.max_batch_calls, len(batch))
+            elif self._n_rows >= self.max_rows:
+                self._cond.notify_all()
+        if leader:
+            try:
+                result = self.fn(np.concatenate([r for r, _ in batch]))
+                ends = np.cumsum([len(r) for r, _ in batch])
+                for (_, f), part in zip(batch, np.split(result, ends[:-1])):
+                    f.set_result(part)
+            except Exception as e:
+                for _, f in batch:
+                    if not f.done():
+                        f.set_exception(e)
+        return future.result()
@@ -5,14 +5,26 @@ import dash_html_components as html
 import dash_core_components as dcc
 import plot_common
 import json
+import flask
 from shapes_to_segmentations import (
+    axis_ranges_to_roi,
     compute_segmentations,
     blend_image_and_classified_regions_pil,
 )
+from image_segmentation import FEATURE_CACHE, IncrementalForest, feature_sigmas
+from shape_utils import SHAPE_MASK_CACHE
+from cache_utils import DiskCache, LRUCache
+from job_utils import CPUBudget, JobCancelled, LatestJobRunner
 import io
+import os
 import base64
+import hashlib
+import tempfile
+import threading
+import time
+import uuid
 import PIL.Image
-import pickle
+import forest_utils
 
 DEFAULT_STROKE_WIDTH = 3  # gives line width of 2^3 = 8
 
@@ -20,6 +32,61 @@ DEFAULT_IMAGE_PATH = "assets/segmentation_img.jpg"
 
 SEG_FEATURE_TYPES = ["intensity", "edges", "texture"]
 
+# Forests updated as strokes are added rather than retrained for each stroke,
+# one per session, for the MAX_SESSION_FORESTS sessions that segmented last.
+MAX_SESSION_FORESTS = 16
+SESSION_FORESTS = LRUCache(max_bytes=float("inf"), max_entries=MAX_SESSION_FORESTS)
+_session_forests_lock = threading.Lock()
+
+# cap on the number of pixels the forest is trained on, balanced between
+# classes and strokes, so that fit time doesn't grow with the painted area
+MAX_TRAINING_PIXELS = 20000
+
+# Each segmentation is first previewed at this resolution level (the image
+# downscaled by 2 ** PREVIEW_RESOLUTION_LEVEL) with a small forest, which takes
+# a fraction of a second, then replaced by the full resolution one.
+PREVIEW_RESOLUTION_LEVEL = 2
+PREVIEW_N_ESTIMATORS = 20
+PREVIEW_MAX_TRAINING_PIXELS = 2000
+
+# When the user is zoomed in, the part of the image in view is segmented at
+# full resolution after the preview and before the rest of the image, unless
+# it is more than MAX_ROI_FRACTION of the image.
+MAX_ROI_FRACTION = 0.5
+
+# directory shared by the gunicorn workers
+CACHE_DIR = os.environ.get(
+    "SEGMENTATION_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "ml_image_segmentation_cache"),
+)
+
+# Segmentations shown by the app, as PNG files named by segmentation_key, and
+# their classifiers (see classifier_key). They live on the server and only
+# their key is sent to the browser.
+SEGMENTATION_CACHE = DiskCache(
+    os.path.join(CACHE_DIR, "segmentations"), max_bytes=256 * 2 ** 20, ttl=3600
+)
+
+# segmentation_key of the latest segmentation requested by each session, so
+# that jobs made stale by a request to another worker are cancelled too
+LATEST_REQUESTS = DiskCache(
+    os.path.join(CACHE_DIR, "sessions"), max_bytes=2 ** 20, ttl=24 * 3600
+)
+
+# Segmentations are computed in background threads, a newer request of a
+# session cancelling the older ones, and the browser polls for the result
+# every SEGMENTATION_POLL_INTERVAL milliseconds.
+SEGMENTATION_JOBS = LatestJobRunner(max_workers=2)
+SEGMENTATION_POLL_INTERVAL = 500
+# seconds after which a pending segmentation is reported as failed, e.g.
+# because the worker computing it died
+SEGMENTATION_TIMEOUT = 600
+
+# Cores of the machine, shared by the segmentations of all the gunicorn
+# workers: each stage of a segmentation gets a share of the free cores
+# instead of a thread per core. Its metrics are served at /cpu-budget.
+CPU_BUDGET = CPUBudget(os.path.join(CACHE_DIR, "cpus"))
+
 # the number of different classes for labels
 NUM_LABEL_CLASSES = 5
 DEFAULT_LABEL_CLASS = 0
@@ -56,39 +123,115 @@ def make_default_figure(
             "newshape.line.color": stroke_color,
             "newshape.line.width": stroke_width,
             "margin": dict(l=0, r=0, b=0, t=0, pad=4),
+            # keep the user's zoom when the figure is redrawn
+            "uirevision": True,
         }
     )
     return fig
 
 
-def shapes_to_key(shapes):
-    return json.dumps(shapes)
+def segmentation_key(image_path, shapes, segmentation_features, sigma_range):
+    """
+    Hex digest identifying the segmentation of the image at image_path (by its
+    contents) computed from shapes with the given features and sigma range.
+    """
+    h = hashlib.sha1()
+    with open(image_path, "rb") as fd:
+        h.update(fd.read())
+    params = [
+        shapes,
+        sorted(segmentation_features),
+        sigma_range,
+        MAX_TRAINING_PIXELS,
+    ]
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def classifier_key(key):
+    """Key of the classifier of the segmentation with key in SEGMENTATION_CACHE"""
+    return hashlib.sha1((key + "classifier").encode()).hexdigest()
+
+
+def preview_key(key):
+    """Key of the coarse preview of the segmentation with key in
+    SEGMENTATION_CACHE"""
+    return hashlib.sha1((key + "preview").encode()).hexdigest()
+
+
+def roi_key(key):
+    """Key of the segmentation of the part of the image in view, over the
+    coarse preview, of the segmentation with key in SEGMENTATION_CACHE"""
+    return hashlib.sha1((key + "roi").encode()).hexdigest()
+
+
+def partial_seg_key(key):
+    """
+    Key of the best partial segmentation of the segmentation with key in
+    SEGMENTATION_CACHE (that of the part in view, then the preview), or None.
+    """
+    for k in [roi_key(key), preview_key(key)]:
+        if k in SEGMENTATION_CACHE:
+            return k
+    return None
 
 
-def store_shapes_seg_pair(d, key, seg, remove_old=True):
+def viewport_roi(viewport, image_path):
     """
-    Stores shapes and segmentation pair in dict d
-    seg is a PIL.Image object
-    if remove_old True, deletes all the old keys and values.
+    Region of interest (see compute_segmentations) of the image at image_path
+    in view in viewport (see update_viewport), or None if none was zoomed
+    into or the region is more than MAX_ROI_FRACTION of the image.
     """
-    # TODO alternatively, if given a numpy array, we could serialize its raw
-    # representation
-    bytes_to_encode = io.BytesIO()
-    seg.save(bytes_to_encode, format="png")
-    bytes_to_encode.seek(0)
-    data = base64.b64encode(bytes_to_encode.read()).decode()
-    if remove_old:
-        return {key: data}
-    d[key] = data
-    return d
-
-
-def look_up_seg(d, key):
-    """ Returns a PIL.Image object """
-    data = d[key]
-    img_bytes = base64.b64decode(data)
-    img = PIL.Image.open(io.BytesIO(img_bytes))
-    return img
+    if not viewport:
+        return None
+    width, height = PIL.Image.open(image_path).size
+    roi = axis_ranges_to_roi(
+        viewport.get("x", [0, width]), viewport.get("y", [0, height]), (height, width)
+    )
+    if roi is None or (roi[1] - roi[0]) * (roi[3] - roi[2]) > (
+        MAX_ROI_FRACTION * width * height
+    ):
+        return None
+    return roi
+
+
+def store_seg(key, seg, classifier=None):
+    """
+    Stores the segmentation seg (a PIL.Image object) as PNG in
+    SEGMENTATION_CACHE, after its classifier (see save_img_classifier) if
+    given. If seg is None, stores that the segmentation failed.
+    """
+    if classifier is not None:
+        SEGMENTATION_CACHE.put(classifier_key(key), classifier)
+    pngbytes = io.BytesIO()
+    if seg is not None:
+        seg.save(pngbytes, format="png")
+    SEGMENTATION_CACHE.put(key, pngbytes.getvalue())
+
+
+def look_up_seg(key):
+    """
+    Returns (done, seg) where done is False if key is not in
+    SEGMENTATION_CACHE (e.g. it is still being computed) and seg is a
+    PIL.Image object, or None if the segmentation failed.
+    """
+    data = SEGMENTATION_CACHE.get(key)
+    if data is None:
+        return (False, None)
+    if len(data) == 0:
+        return (True, None)
+    return (True, PIL.Image.open(io.BytesIO(data)))
+
+
+def look_up_classifier(key):
+    """
+    Returns the classifier stored with the segmentation key as a data URI of
+    its .npz file (see save_img_classifier), or None
+    """
+    data = SEGMENTATION_CACHE.get(classifier_key(key))
+    if data is None:
+        return None
+    return "data:application/octet-stream;base64," + base64.b64encode(data).decode()
 
 
 app.layout = html.Div(
@@ -202,7 +345,7 @@ app.layout = html.Div(
                         # annotations by clicking on a button
                         html.A(
                             id="download",
-                            download="classifier.json",
+                            download="classifier.npz",
                             children=[
                                 html.Button("Download classifier", id="download-button"),
                                 html.Span(
@@ -233,13 +376,25 @@ app.layout = html.Div(
                 # Store for user created masks
                 # data is a list of dicts describing shapes
                 dcc.Store(id="masks", data={"shapes": []}),
-                # Store for storing segmentations from shapes
-                # the keys are hashes of shape lists and the data are pngdata
-                # representing the corresponding segmentation
-                # this is so we can download annotations and also not recompute
-                # needlessly old segmentations
-                dcc.Store(id="segmentation", data={}),
-                dcc.Store(id="classifier-store", data={}),
+                # Store for the segmentation_key of the segmentation shown
+                # the segmentations themselves are in SEGMENTATION_CACHE, on
+                # the server, so that old segmentations are not recomputed
+                # needlessly
+                dcc.Store(id="segmentation", data=""),
+                # Store for the segmentation being computed in the
+                # background, as a dict with its segmentation_key ("key")
+                # and the time it was requested at ("started"), polled for
+                # by segmentation-poll while not None
+                dcc.Store(id="pending-segmentation", data=None),
+                dcc.Store(id="session-id", data=None),
+                # Store for the axis ranges of the graph (see update_viewport)
+                dcc.Store(id="viewport", data=None),
+                dcc.Interval(
+                    id="segmentation-poll",
+                    interval=SEGMENTATION_POLL_INTERVAL,
+                    disabled=True,
+                ),
+                dcc.Store(id="classifier-store", data=""),
                 dcc.Store(id="classified-image-store", data=""),
             ],
         ),
@@ -248,30 +403,84 @@ app.layout = html.Div(
 
 
 def save_img_classifier(clf, segmenter_args, label_to_colors_args):
+    """
+    Returns the contents of the .npz file of the classifier clf and the
+    arguments to use it with (see forest_utils.save_forest), which
+    use_ml_image_segmentation_classifier.py loads, with the sigmas of its
+    features, which loading checks (see image_segmentation.check_sigmas).
+    """
     clfbytes = io.BytesIO()
-    pickle.dump(clf, clfbytes)
-    clfb64 = base64.b64encode(clfbytes.getvalue()).decode()
-    return {
-        "classifier": clfb64,
-        "segmenter_args": segmenter_args,
-        "label_to_colors_args": label_to_colors_args,
-    }
+    forest_utils.save_forest(
+        clfbytes,
+        clf,
+        segmenter_args=segmenter_args,
+        sigmas=feature_sigmas(**segmenter_args),
+        label_to_colors_args=label_to_colors_args,
+    )
+    return clfbytes.getvalue()
 
 
-def show_segmentation(image_path, mask_shapes, segmenter_args):
-    """ adds an image showing segmentations to a figure's layout """
+def session_forest(session_id):
+    """ The IncrementalForest of session_id in SESSION_FORESTS """
+    with _session_forests_lock:
+        forest = SESSION_FORESTS.get(session_id)
+        if forest is None:
+            forest = IncrementalForest()
+            SESSION_FORESTS.put(session_id, forest)
+        return forest
+
+
+def show_segmentation(
+    image_path,
+    mask_shapes,
+    segmenter_args,
+    checkpoint=None,
+    preview=False,
+    roi=None,
+    session_id=None,
+):
+    """
+    adds an image showing segmentations to a figure's layout
+    if preview is True, the segmentation is a coarse one, computed at
+    PREVIEW_RESOLUTION_LEVEL with a small forest.
+    if roi is given, only that region of the image is segmented (see
+    compute_segmentations).
+    if session_id is given, the forest of the full resolution segmentation is
+    an update of that of the previous segmentation of the session (see
+    session_forest).
+    """
     # add 1 because classifier takes 0 to mean no mask
     shape_layers = [color_to_class(shape["line"]["color"]) + 1 for shape in mask_shapes]
     label_to_colors_args = {
         "colormap": class_label_colormap,
         "color_class_offset": -1,
     }
+    run_args = dict(max_training_pixels=MAX_TRAINING_PIXELS)
+    if preview:
+        run_args.update(
+            max_training_pixels=PREVIEW_MAX_TRAINING_PIXELS,
+            n_estimators=PREVIEW_N_ESTIMATORS,
+        )
     segimg, _, clf = compute_segmentations(
         mask_shapes,
         img_path=image_path,
-        segmenter_args=segmenter_args,
+        segmenter_args=dict(segmenter_args, **run_args),
         shape_layers=shape_layers,
         label_to_colors_args=label_to_colors_args,
+        # the image rarely changes between strokes, so most feature planes
+        # can be reused
+        feature_cache=FEATURE_CACHE,
+        incremental_forest=(
+            None if preview or session_id is None else session_forest(session_id)
+        ),
+        shape_mask_cache=SHAPE_MASK_CACHE,
+        # compute the features of the channels and sigmas in parallel threads,
+        # with the cores CPU_BUDGET allocates
+        feature_n_jobs=-1,
+        cpu_budget=CPU_BUDGET,
+        checkpoint=checkpoint,
+        resolution_level=PREVIEW_RESOLUTION_LEVEL if preview else 0,
+        roi=roi,
     )
     # get the classifier that we can later store in the Store
     classifier = save_img_classifier(clf, segmenter_args, label_to_colors_args)
@@ -279,6 +488,73 @@ def show_segmentation(image_path, mask_shapes, segmenter_args):
     return (segimgpng, classifier)
 
 
+def segmentation_job(
+    key, image_path, mask_shapes, segmenter_args, checkpoint, roi=None, session_id=None
+):
+    """
+    Background job (see SEGMENTATION_JOBS) computing the segmentation of
+    show_segmentation and storing it with its classifier under key in
+    SEGMENTATION_CACHE, where the poll of annotation_react picks it up. A
+    coarse preview is computed and stored (under preview_key(key)) first,
+    then, if roi is given, the segmentation of that region pasted over the
+    preview (under roi_key(key)). The forests are updates of those of the
+    previous segmentations of session_id.
+    """
+    try:
+        # the preview may also have expired since it was stored, in which
+        # case it is computed again before the region is pasted over it
+        previewpng = look_up_seg(preview_key(key))[1]
+        if previewpng is None:
+            previewpng, _ = show_segmentation(
+                image_path,
+                mask_shapes,
+                segmenter_args,
+                checkpoint=checkpoint,
+                preview=True,
+            )
+            store_seg(preview_key(key), previewpng)
+            checkpoint()
+        if roi is not None and roi_key(key) not in SEGMENTATION_CACHE:
+            roiimgpng, _ = show_segmentation(
+                image_path,
+                mask_shapes,
+                segmenter_args,
+                checkpoint=checkpoint,
+                roi=roi,
+                session_id=session_id,
+            )
+            segimgpng = previewpng.copy()
+            segimgpng.paste(roiimgpng, (roi[2], roi[0]))
+            store_seg(roi_key(key), segimgpng)
+            checkpoint()
+        segimgpng, classifier = show_segmentation(
+            image_path,
+            mask_shapes,
+            segmenter_args,
+            checkpoint=checkpoint,
+            session_id=session_id,
+        )
+    except JobCancelled:
+        raise
+    except Exception:
+        # nobody reads the job's Future, so the error is only seen in the log
+        app.logger.exception("Segmentation %s failed", key)
+        # if segmentation fails, draw nothing (and stop polling)
+        store_seg(key, None)
+        raise
+    store_seg(key, segimgpng, classifier)
+
+
+def request_segmentation(session_id, key):
+    """
+    Makes key the latest segmentation requested by session_id (an empty key
+    requests none), which cancels the session's jobs for other keys.
+    """
+    LATEST_REQUESTS.put(session_id, key.encode())
+    if key == "":
+        SEGMENTATION_JOBS.cancel(session_id)
+
+
 @app.callback(
     [
         Output("graph", "figure"),
@@ -287,6 +563,9 @@ def show_segmentation(image_path, mask_shapes, segmenter_args):
         Output("stroke-width-display", "children"),
         Output("classifier-store", "data"),
         Output("classified-image-store", "data"),
+        Output("pending-segmentation", "data"),
+        Output("segmentation-poll", "disabled"),
+        Output("session-id", "data"),
     ],
     [
         Input("graph", "relayoutData"),
@@ -298,12 +577,16 @@ def show_segmentation(image_path, mask_shapes, segmenter_args):
         Input("show-segmentation", "value"),
         Input("segmentation-features", "value"),
         Input("sigma-range-slider", "value"),
+        Input("segmentation-poll", "n_intervals"),
     ],
     [
         State("masks", "data"),
         State("segmentation", "data"),
         State("classifier-store", "data"),
         State("classified-image-store", "data"),
+        State("pending-segmentation", "data"),
+        State("session-id", "data"),
+        State("viewport", "data"),
     ],
 )
 def annotation_react(
@@ -313,10 +596,14 @@ def annotation_react(
     show_segmentation_value,
     segmentation_features_value,
     sigma_range_slider_value,
+    segmentation_poll_n_intervals,
     masks_data,
     segmentation_data,
     classifier_store_data,
     classified_image_store_data,
+    pending_segmentation_data,
+    session_id_data,
+    viewport_data,
 ):
     cbcontext = [p["prop_id"] for p in dash.callback_context.triggered][0]
     if cbcontext == "graph.relayoutData":
@@ -324,6 +611,27 @@ def annotation_react(
             masks_data["shapes"] = graph_relayoutData["shapes"]
         else:
             return dash.no_update
+    if cbcontext == "segmentation-poll.n_intervals":
+        # only redraw once the pending segmentation or a better partial one
+        # is done, or it timed out
+        if not pending_segmentation_data:
+            return dash.no_update
+        pending_key = pending_segmentation_data["key"]
+        timed_out = (
+            time.time() - pending_segmentation_data["started"] > SEGMENTATION_TIMEOUT
+        )
+        partial = partial_seg_key(pending_key)
+        if not (
+            timed_out
+            or look_up_seg(pending_key)[0]
+            or (partial is not None and partial != segmentation_data)
+        ):
+            return dash.no_update
+    else:
+        pending_key = pending_segmentation_data and pending_segmentation_data["key"]
+        timed_out = False
+    if session_id_data is None:
+        session_id_data = uuid.uuid4().hex
     stroke_width = int(round(2 ** (stroke_width_value)))
     # find label class value by finding button with the greatest n_clicks
     if any_label_class_button_value is None:
@@ -338,50 +646,76 @@ def annotation_react(
         stroke_width=stroke_width,
         shapes=masks_data["shapes"],
     )
-    if ("Show segmentation" in show_segmentation_value) and (
-        len(masks_data["shapes"]) > 0
+    requested = ""
+    if (
+        ("Show segmentation" in show_segmentation_value)
+        and (len(masks_data["shapes"]) > 0)
+        and (len(segmentation_features_value) > 0)
     ):
-        # to store segmentation data in the store, we need to base64 encode the
-        # PIL.Image and hash the set of shapes to use this as the key
-        # to retrieve the segmentation data, we need to base64 decode to a PIL.Image
-        # because this will give the dimensions of the image
-        sh = shapes_to_key(
-            [
-                masks_data["shapes"],
-                segmentation_features_value,
-                sigma_range_slider_value,
-            ]
+        # segmentations are stored on the server as PNG, the browser only
+        # keeps the key of the one shown
+        requested = segmentation_key(
+            DEFAULT_IMAGE_PATH,
+            masks_data["shapes"],
+            segmentation_features_value,
+            sigma_range_slider_value,
         )
-        if sh in segmentation_data.keys():
-            segimgpng = look_up_seg(segmentation_data, sh)
+    already_pending = requested == pending_key
+    if not already_pending:
+        request_segmentation(session_id_data, requested)
+    started = pending_segmentation_data and pending_segmentation_data["started"]
+    pending_segmentation_data = None
+    segimgpng = None
+    if requested != "":
+        done, segimgpng = look_up_seg(requested)
+        if timed_out and already_pending and not done:
+            # draw nothing and stop polling, as when the segmentation fails;
+            # it is submitted again the next time it is requested
+            app.logger.warning("Segmentation %s timed out", requested)
+            done = True
+        if done:
+            if requested != segmentation_data and segimgpng is not None:
+                classifier_store_data = look_up_classifier(requested)
+                classified_image_store_data = plot_common.pil_image_to_uri(
+                    blend_image_and_classified_regions_pil(
+                        PIL.Image.open(DEFAULT_IMAGE_PATH), segimgpng
+                    )
+                )
+            segmentation_data = requested
         else:
-            segimgpng = None
-            try:
+            if not already_pending:
+                started = time.time()
                 feature_opts = {
                     key: (key in segmentation_features_value)
                     for key in SEG_FEATURE_TYPES
                 }
                 feature_opts["sigma_min"] = sigma_range_slider_value[0]
                 feature_opts["sigma_max"] = sigma_range_slider_value[1]
-                if len(segmentation_features_value) > 0:
-                    segimgpng, classifier_store_data = show_segmentation(
-                        DEFAULT_IMAGE_PATH, masks_data["shapes"], feature_opts
-                    )
-                    segmentation_data = store_shapes_seg_pair(
-                        segmentation_data, sh, segimgpng
-                    )
-                    classified_image_store_data = plot_common.pil_image_to_uri(
-                        blend_image_and_classified_regions_pil(
-                            PIL.Image.open(DEFAULT_IMAGE_PATH), segimgpng
-                        )
-                    )
-            except ValueError:
-                # if segmentation fails, draw nothing
-                pass
-        images_to_draw = []
-        if segimgpng is not None:
-            images_to_draw = [segimgpng]
-        fig = plot_common.add_layout_images_to_fig(fig, images_to_draw)
+                SEGMENTATION_JOBS.submit(
+                    session_id_data,
+                    segmentation_job,
+                    requested,
+                    DEFAULT_IMAGE_PATH,
+                    masks_data["shapes"],
+                    feature_opts,
+                    roi=viewport_roi(viewport_data, DEFAULT_IMAGE_PATH),
+                    session_id=session_id_data,
+                    is_stale=lambda: LATEST_REQUESTS.get(session_id_data)
+                    != requested.encode(),
+                )
+            pending_segmentation_data = {"key": requested, "started": started}
+            partial = partial_seg_key(requested)
+            if partial is not None:
+                segimgpng = look_up_seg(partial)[1]
+                segmentation_data = partial
+            elif segmentation_data != "":
+                # keep showing the previous segmentation until the preview
+                # of the new one is done
+                segimgpng = look_up_seg(segmentation_data)[1]
+    images_to_draw = []
+    if segimgpng is not None:
+        images_to_draw = [segimgpng]
+    fig = plot_common.add_layout_images_to_fig(fig, images_to_draw)
     return (
         fig,
         masks_data,
@@ -389,18 +723,53 @@ def annotation_react(
         "Stroke width: %d" % (stroke_width,),
         classifier_store_data,
         classified_image_store_data,
+        pending_segmentation_data,
+        pending_segmentation_data is None,
+        session_id_data,
     )
 
 
-# set the download url to the contents of the classifier-store (so they can be
-# downloaded from the browser's memory)
+@app.callback(
+    Output("viewport", "data"),
+    [Input("graph", "relayoutData")],
+    [State("viewport", "data")],
+)
+def update_viewport(graph_relayoutData, viewport_data):
+    """
+    Keeps the axis ranges the user zoomed or panned the graph to, as a dict
+    with "x" and "y" ranges (an axis that is autoranged has none).
+    """
+    if graph_relayoutData is None:
+        return dash.no_update
+    viewport = dict(viewport_data or {})
+    for axis in ["x", "y"]:
+        prefix = axis + "axis."
+        if graph_relayoutData.get(prefix + "autorange"):
+            viewport.pop(axis, None)
+        elif prefix + "range[0]" in graph_relayoutData:
+            viewport[axis] = [
+                graph_relayoutData[prefix + "range[0]"],
+                graph_relayoutData[prefix + "range[1]"],
+            ]
+        elif prefix + "range" in graph_relayoutData:
+            viewport[axis] = list(graph_relayoutData[prefix + "range"])
+    if viewport == (viewport_data or {}):
+        return dash.no_update
+    return viewport
+
+
+@server.route("/cpu-budget")
+def cpu_budget_metrics():
+    """ Queue depth and allocations of CPU_BUDGET, as JSON """
+    return flask.jsonify(CPU_BUDGET.stats())
+
+
+# set the download url to the contents of the classifier-store, a data URI (so
+# they can be downloaded from the browser's memory)
 app.clientside_callback(
     """
 function(the_store_data) {
-    let s = JSON.stringify(the_store_data);
-    let b = new Blob([s],{type: 'text/plain'});
-    let url = URL.createObjectURL(b);
-    return url;
+    return the_store_data;
 }
 """,
     Output("download", "href"),
@@ -1,14 +1,40 @@
-from cairosvg import svg2png
 import skimage
 import PIL.Image
 import io
+import re
+import json
+import hashlib
 import numpy as np
+from cache_utils import LRUCache
 
+# Pixels that the stroke's outline reaches get a non-zero value when CairoSVG
+# antialiases the stroke, so they count as part of the mask: those whose
+# center is within ANTIALIAS_MARGIN of the outline (up to sqrt(2) times more
+# for slanted edges), less ANTIALIAS_SAMPLE_SLACK as cairo samples coverage at
+# 15 rows of points per pixel, which a stroke reaching a pixel by less than
+# half their spacing can miss.
+ANTIALIAS_MARGIN = 0.5
+ANTIALIAS_SAMPLE_SLACK = 1 / 30.0
 
-def shape_to_svg_code(shape, fig=None, width=None, height=None):
+# SVG's default stroke-miterlimit: joins whose miter would be longer than this
+# many stroke widths are beveled
+SVG_MITER_LIMIT = 4
+
+# Rasterized shapes as flat pixel indices, keyed by shape_digest and method.
+# Pass it as the cache argument of shapes_to_mask.
+SHAPE_MASK_CACHE = LRUCache(max_bytes=128 * 2 ** 20)
+
+# SVG path commands understood by the native rasterizer. Plotly's drawopenpath
+# and drawclosedpath only produce absolute M, L and Z commands.
+_PATH_TOKEN_RE = re.compile(
+    r"([MLHVZmlhvz])|([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)"
+)
+
+
+def shape_canvas_size(fig=None, width=None, height=None):
     """
-    fig is the figure which shape resides in (to get width and height) and shape
-    is one of the shapes the figure contains.
+    Returns the (width, height) of the canvas a shape is drawn on, either
+    from the axis ranges of fig or from width and height.
     """
     if fig is not None:
         # get width and height
@@ -18,6 +44,15 @@ def shape_to_svg_code(shape, fig=None, width=None, height=None):
     else:
         if width is None or height is None:
             raise ValueError("If fig is None, you must specify width and height")
+    return width, height
+
+
+def shape_to_svg_code(shape, fig=None, width=None, height=None):
+    """
+    fig is the figure which shape resides in (to get width and height) and shape
+    is one of the shapes the figure contains.
+    """
+    width, height = shape_canvas_size(fig=fig, width=width, height=height)
     fmt_dict = dict(
         width=width,
         height=height,
@@ -48,12 +83,278 @@ def shape_to_png(fig=None, shape=None, width=None, height=None, write_to=None):
     Like svg2png, if write_to is None, returns a bytestring. If it is a path
     to a file it writes to this file and returns None.
     """
+    # CairoSVG needs the cairo library, which the native rasterizer doesn't
+    from cairosvg import svg2png
+
     svg_code = shape_to_svg_code(fig=fig, shape=shape, width=width, height=height)
     r = svg2png(bytestring=svg_code, write_to=write_to)
     return r
 
 
-def shapes_to_mask(shape_args, shape_layers):
+def _tokenize_path(path):
+    """
+    Splits SVG path data into a list of command letters and floats.
+    """
+    tokens = []
+    pos = 0
+    for m in _PATH_TOKEN_RE.finditer(path):
+        if path[pos : m.start()].strip(" ,\t\n") != "":
+            raise ValueError("Unsupported path data: %r" % (path[pos : m.start()],))
+        cmd, num = m.groups()
+        tokens.append(cmd if cmd is not None else float(num))
+        pos = m.end()
+    if path[pos:].strip(" ,\t\n") != "":
+        raise ValueError("Unsupported path data: %r" % (path[pos:],))
+    return tokens
+
+
+def path_to_polylines(path):
+    """
+    Parses an SVG path made of M, L, H, V and Z commands (absolute or relative)
+    into a list of (points, closed) pairs, one per subpath, where points is an
+    array of (x, y) rows.
+    Raises ValueError for other commands (e.g., curves).
+    """
+    tokens = _tokenize_path(path)
+    polylines = []
+    points = []
+    cmd = None
+    cur = start = np.zeros(2)
+    i = 0
+    while i < len(tokens):
+        if type(tokens[i]) == type(str()):
+            cmd = tokens[i]
+            i += 1
+            if cmd in "Zz":
+                if len(points) > 0:
+                    polylines.append((np.array(points), True))
+                points = []
+                cur = start
+            continue
+        if cmd is None or cmd in "Zz":
+            raise ValueError("Expected a command in path %r" % (path,))
+        n_args = 2 if cmd in "MmLl" else 1
+        args = tokens[i : i + n_args]
+        if len(args) < n_args or any(type(a) == type(str()) for a in args):
+            raise ValueError("Incomplete coordinates in path %r" % (path,))
+        i += n_args
+        relative = cmd.islower()
+        if cmd in "MmLl":
+            xy = np.array(args) + (cur if relative else 0)
+        else:
+            axis = 0 if cmd in "Hh" else 1
+            xy = cur.copy()
+            xy[axis] = args[0] + (cur[axis] if relative else 0)
+        if cmd in "Mm":
+            if len(points) > 0:
+                polylines.append((np.array(points), False))
+            points = []
+            start = xy
+            # further coordinate pairs are implicit lineto commands
+            cmd = "l" if relative else "L"
+        elif len(points) == 0:
+            # drawing after Z continues from the start of the closed subpath
+            points = [cur]
+        points.append(xy)
+        cur = xy
+    if len(points) > 0:
+        polylines.append((np.array(points), False))
+    return polylines
+
+
+def shape_to_polylines(shape):
+    """
+    Returns the outline of a Plotly shape ("path" or "rect") as a list of
+    (points, closed) pairs, see path_to_polylines.
+    """
+    if shape.get("type", "path") == "rect":
+        x0, y0, x1, y1 = [float(shape[k]) for k in ["x0", "y0", "x1", "y1"]]
+        points = np.array([[x0, y0], [x1, y0], [x1, y1], [x0, y1]])
+        return [(points, True)]
+    if "path" not in shape:
+        raise ValueError("Unsupported shape type %r" % (shape.get("type"),))
+    return path_to_polylines(shape["path"])
+
+
+def _fill_convex_polygon(mask, vertices):
+    """Sets to True the pixels of mask whose center is inside the convex
+    polygon with the (x, y) rows vertices, in either orientation"""
+    height, width = mask.shape
+    c0 = max(int(np.floor(vertices[:, 0].min())), 0)
+    c1 = min(int(np.ceil(vertices[:, 0].max())) + 1, width)
+    r0 = max(int(np.floor(vertices[:, 1].min())), 0)
+    r1 = min(int(np.ceil(vertices[:, 1].max())) + 1, height)
+    if c0 >= c1 or r0 >= r1:
+        return
+    x = np.arange(c0, c1) + 0.5
+    y = (np.arange(r0, r1) + 0.5)[:, None]
+    # the center of the polygon is on the inner side of every edge
+    center = vertices.mean(axis=0)
+    inside = np.ones((r1 - r0, c1 - c0), dtype=bool)
+    for a, b in zip(vertices, np.roll(vertices, -1, axis=0)):
+        e = b - a
+        side = e[0] * (center[1] - a[1]) - e[1] * (center[0] - a[0])
+        if side == 0:
+            continue
+        inside &= np.sign(side) * (e[0] * (y - a[1]) - e[1] * (x - a[0])) >= 0
+    mask[r0:r1, c0:c1] |= inside
+
+
+def _join_polygon(p, u0, u1, radius):
+    """Polygon filling the outer side of the join at p of two segments with
+    the unit directions u0 and u1: a miter, or a bevel if the miter would be
+    longer than SVG_MITER_LIMIT times the stroke width. None for straight
+    joins."""
+    cross = u0[0] * u1[1] - u0[1] * u1[0]
+    if cross == 0:
+        return None
+    # normals pointing out of the turn
+    n0 = -np.sign(cross) * np.array([-u0[1], u0[0]])
+    n1 = -np.sign(cross) * np.array([-u1[1], u1[0]])
+    a, b = p + radius * n0, p + radius * n1
+    cos = n0.dot(n1)
+    # the miter is 1 / cos(angle / 2) times the stroke width
+    if (1 + cos) / 2 < 1.0 / SVG_MITER_LIMIT ** 2:
+        return np.array([p, a, b])
+    tip = p + radius * (n0 + n1) / (1 + cos)
+    return np.array([p, a, tip, b])
+
+
+def _draw_polyline(mask, points, closed, half_width):
+    """
+    Sets to True the pixels of mask that the stroke of the polyline of half
+    width half_width reaches, with SVG's default stroke style: the segments are
+    rectangles, joined by miters (bevels beyond SVG_MITER_LIMIT), and the ends
+    of open polylines are butt caps (with ANTIALIAS_MARGIN of slack).
+    """
+    height, width = mask.shape
+    # repeated points make no segment and no join
+    keep = np.ones(len(points), dtype=bool)
+    keep[1:] = np.any(np.diff(points, axis=0) != 0, axis=1)
+    points = points[keep]
+    if closed and len(points) > 1 and np.array_equal(points[0], points[-1]):
+        points = points[:-1]
+    if len(points) < 2:
+        return
+    if closed:
+        points = np.concatenate((points, points[:1]))
+    n_segments = len(points) - 1
+    directions = []
+    for n in range(n_segments):
+        p0, p1 = points[n], points[n + 1]
+        d = p1 - p0
+        len2 = d.dot(d)
+        directions.append(d / np.sqrt(len2))
+        # distance from the center of a pixel of its square's furthest point
+        # across the segment
+        margin = ANTIALIAS_MARGIN * np.abs(d).sum() / np.sqrt(len2)
+        radius = half_width + margin - ANTIALIAS_SAMPLE_SLACK
+        c0 = max(int(np.floor(min(p0[0], p1[0]) - radius)), 0)
+        c1 = min(int(np.ceil(max(p0[0], p1[0]) + radius)) + 1, width)
+        r0 = max(int(np.floor(min(p0[1], p1[1]) - radius)), 0)
+        r1 = min(int(np.ceil(max(p0[1], p1[1]) + radius)) + 1, height)
+        if c0 >= c1 or r0 >= r1:
+            continue
+        # pixel centers relative to p0
+        x = np.arange(c0, c1) + 0.5 - p0[0]
+        y = (np.arange(r0, r1) + 0.5 - p0[1])[:, None]
+        t = (x * d[0] + y * d[1]) / len2
+        inside = (x * d[1] - y * d[0]) ** 2 < radius ** 2 * len2
+        lo, hi = 0, 1
+        if not closed:
+            slack = ANTIALIAS_MARGIN / np.sqrt(len2)
+            if n == 0:
+                lo = -slack
+            if n == n_segments - 1:
+                hi = 1 + slack
+        inside &= (t >= lo) & (t <= hi)
+        mask[r0:r1, c0:c1] |= inside
+    joins = range(n_segments) if closed else range(1, n_segments)
+    for n in joins:
+        polygon = _join_polygon(
+            points[n], directions[n - 1], directions[n], half_width + ANTIALIAS_MARGIN
+        )
+        if polygon is not None:
+            _fill_convex_polygon(mask, polygon)
+
+
+def shape_to_mask(shape, fig=None, width=None, height=None):
+    """
+    Rasterizes the stroke of shape (a Plotly "path" or "rect" shape) directly
+    into a boolean array of shape (height, width), without going through SVG
+    and PNG. The result approximates the non-zero pixels of shape_to_png.
+    fig, width and height are as in shape_to_svg_code.
+    """
+    width, height = shape_canvas_size(fig=fig, width=width, height=height)
+    width, height = [int(np.ceil(s)) for s in [width, height]]
+    mask = np.zeros((height, width), dtype=bool)
+    for points, closed in shape_to_polylines(shape):
+        _draw_polyline(mask, points, closed, shape["line"]["width"] / 2.0)
+    return mask
+
+
+def shape_to_mask_cairo(shape, fig=None, width=None, height=None):
+    """
+    Like shape_to_mask but renders shape with CairoSVG.
+    """
+    pngbytes = shape_to_png(fig=fig, shape=shape, width=width, height=height)
+    imary = skimage.util.img_as_ubyte(np.array(PIL.Image.open(io.BytesIO(pngbytes))))
+    return np.sum(imary, axis=2) != 0
+
+
+def shape_digest(shape, width, height):
+    """
+    Hex digest of the parts of shape that determine its rasterization (its
+    geometry and line width, not its color) and of the canvas size.
+    """
+    geometry = {k: shape.get(k) for k in ["type", "path", "x0", "y0", "x1", "y1"]}
+    geometry["line_width"] = shape["line"]["width"]
+    key = json.dumps([geometry, width, height], sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def _rasterize_shape(sa, method):
+    sa = {k: v for k, v in sa.items() if k != "write_to"}
+    if method == "native":
+        try:
+            return shape_to_mask(**sa)
+        except ValueError:
+            pass
+    elif method != "cairo":
+        raise ValueError("Unknown method %r" % (method,))
+    return shape_to_mask_cairo(**sa)
+
+
+def shape_pixels(sa, method="native", cache=None):
+    """
+    Rasterizes the shape described by sa (the parameters to shape_to_png)
+    and returns (indices, (height, width)) where indices are the flat indices
+    of its pixels in a (height, width) array.
+    If cache is an LRUCache (e.g. SHAPE_MASK_CACHE), shapes with the same
+    shape_digest are only rasterized once.
+    """
+    key = None
+    if cache is not None:
+        width, height = shape_canvas_size(
+            fig=sa.get("fig"), width=sa.get("width"), height=sa.get("height")
+        )
+        key = (shape_digest(sa["shape"], width, height), method)
+        pixels = cache.get(key)
+        if pixels is not None:
+            return pixels
+    im = _rasterize_shape(sa, method)
+    indices = np.flatnonzero(im)
+    indices = indices.astype(np.int32 if im.size < 2 ** 31 else np.int64)
+    indices.flags.writeable = False
+    pixels = (indices, im.shape)
+    if cache is not None:
+        cache.put(key, pixels)
+    return pixels
+
+
+def shapes_to_mask(
+    shape_args, shape_layers, method="native", return_shape_masks=False, cache=None
+):
     """
     Returns numpy array (type uint8) with number of rows equal to maximum height
     of all shapes's bounding boxes and number of columns equal to their number
@@ -67,24 +368,35 @@ def shapes_to_mask(shape_args, shape_layers):
     if an array, must be the same length as shape_args and each entry is an
     integer in [0...255] specifying the layer number. Note that the convention
     is that 0 means no mask, so generally the layer numbers will be non-zero.
+    method is "native" to rasterize the shapes with shape_to_mask (shapes it
+    can't parse are rendered with CairoSVG) or "cairo" to render all of them
+    with CairoSVG.
+    Each shape is rendered once and the shapes are drawn in order, so later
+    shapes are on top of earlier ones. If return_shape_masks is True, returns
+    (mask, shape_masks) where shape_masks is the list of boolean arrays each
+    shape was rendered to.
+    cache is passed to shape_pixels, so that only the shapes that are new or
+    were edited since the previous call are rasterized.
     """
-    images = []
-    for sa in shape_args:
-        pngbytes = shape_to_png(**sa)
-        images.append(PIL.Image.open(io.BytesIO(pngbytes)))
+    pixels = [shape_pixels(sa, method=method, cache=cache) for sa in shape_args]
 
-    mwidth, mheight = [max([im.size[i] for im in images]) for i in range(2)]
+    mheight, mwidth = [max([shp[i] for _, shp in pixels]) for i in range(2)]
     mask = np.zeros((mheight, mwidth), dtype=np.uint8)
     if type(shape_layers) != type(list()):
         layer_numbers = [shape_layers for _ in shape_args]
     else:
         layer_numbers = shape_layers
-    imarys = []
-    for layer_num, im in zip(layer_numbers, images):
+    for layer_num, (indices, (height, width)) in zip(layer_numbers, pixels):
         # layer 0 is reserved for no mask
-        imary = skimage.util.img_as_ubyte(np.array(im))
-        imary = np.sum(imary, axis=2)
-        imary.resize((mheight, mwidth))
-        imarys.append(imary)
-        mask[imary != 0] = layer_num
+        if (height, width) == mask.shape:
+            mask.ravel()[indices] = layer_num
+        else:
+            mask[indices // width, indices % width] = layer_num
+    if return_shape_masks:
+        shape_masks = []
+        for indices, shp in pixels:
+            im = np.zeros(shp, dtype=bool)
+            im.ravel()[indices] = True
+            shape_masks.append(im)
+        return mask, shape_masks
     return mask
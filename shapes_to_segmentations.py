@@ -1,10 +1,10 @@
 import PIL.Image
+import functools
 import numpy as np
 import skimage
 import skimage.util
 import skimage.io
 import skimage.color
-import io
 import shape_utils
 from image_segmentation import trainable_segmentation
 import plotly.express as px
@@ -24,8 +24,39 @@ def fromhex(n):
     return int(n, base=16)
 
 
+@functools.lru_cache(maxsize=32)
+def colormap_to_palette(colormap, alpha=128):
+    """
+    colormap is a tuple of strings like plotly.express style colormaps.
+    Returns a read-only (len(colormap), 4) uint8 array of their RGBA values,
+    where alpha is the value of the 4th channel.
+    """
+    palette = np.array(
+        [
+            tuple([fromhex(h[s : s + 2]) for s in range(0, len(h), 2)]) + (alpha,)
+            for h in [c.replace("#", "") for c in colormap]
+        ],
+        dtype="uint8",
+    )
+    palette.flags.writeable = False
+    return palette
+
+
+@functools.lru_cache(maxsize=32)
+def _ubyte_label_palette(colormap, alpha, color_class_offset):
+    """ (256, 4) uint8 array giving the color of every possible ubyte label """
+    palette = colormap_to_palette(colormap, alpha)
+    lut = palette[(np.arange(256) + color_class_offset) % len(palette)]
+    lut.flags.writeable = False
+    return lut
+
+
 def label_to_colors(
-    img, colormap=px.colors.qualitative.Light24, alpha=128, color_class_offset=0
+    img,
+    colormap=px.colors.qualitative.Light24,
+    alpha=128,
+    color_class_offset=0,
+    out=None,
 ):
     """
     Take MxN matrix containing integers representing labels and return an MxNx4
@@ -36,19 +67,19 @@ def label_to_colors(
     use of a particular range of colors in the colormap. This is useful for
     example if 0 means 'no class' but we want the color of class 1 to be
     colormap[0].
+    If out (a MxNx4 uint8 array) is given, the colors are written to it.
     """
-    colormap = [
-        tuple([fromhex(h[s : s + 2]) for s in range(0, len(h), 2)])
-        for h in [c.replace("#", "") for c in colormap]
-    ]
-    cimg = np.zeros(img.shape[:2] + (3,), dtype="uint8")
-    minc = np.min(img)
-    maxc = np.max(img)
-    for c in range(minc, maxc + 1):
-        cimg[img == c] = colormap[(c + color_class_offset) % len(colormap)]
-    return np.concatenate(
-        (cimg, alpha * np.ones(img.shape[:2] + (1,), dtype="uint8")), axis=2
-    )
+    colormap = tuple(colormap)
+    if img.dtype == np.uint8:
+        palette = _ubyte_label_palette(colormap, alpha, color_class_offset)
+        indices = img
+    else:
+        palette = colormap_to_palette(colormap, alpha)
+        indices = np.mod(img.astype(np.intp) + color_class_offset, len(palette))
+    if out is None:
+        out = np.empty(img.shape[:2] + (4,), dtype="uint8")
+    # indices are always valid, and mode="clip" avoids np.take buffering out
+    return np.take(palette, indices, axis=0, out=out, mode="clip")
 
 
 def grey_labels(img):
@@ -66,40 +97,130 @@ def compute_segmentations(
     segmenter_args={},
     shape_layers=None,
     label_to_colors_args={},
+    feature_cache=None,
+    incremental_forest=None,
+    return_shape_masks=False,
+    shape_mask_cache=None,
+    feature_n_jobs=1,
+    checkpoint=None,
+    resolution_level=0,
+    roi=None,
+    cpu_budget=None,
 ):
+    """
+    Returns (color_seg, seg, clf), or (color_seg, seg, clf, shape_masks) if
+    return_shape_masks is True, where shape_masks are the boolean masks each
+    shape was rasterized to (see shape_utils.shapes_to_mask).
+    feature_cache, incremental_forest, feature_n_jobs and cpu_budget are
+    passed on to trainable_segmentation, see image_segmentation.compute_features and
+    image_segmentation.IncrementalForest.
+    shape_mask_cache is passed on to shape_utils.shapes_to_mask.
+    checkpoint, if given, is called between the stages of the computation
+    (see trainable_segmentation); raising an exception from it cancels the
+    computation.
+    resolution_level is passed on to trainable_segmentation: with n > 0, a
+    coarse segmentation is computed on the image downscaled by 2 ** n and
+    upscaled to the image's size, e.g. as a quick preview.
+    roi is passed on to trainable_segmentation: if given, a (row_start,
+    row_stop, col_start, col_stop) region of interest, e.g. from
+    axis_ranges_to_roi, only the region is segmented and color_seg and seg are
+    its segmentation.
+    """
 
     # load original image
     img = img_to_ubyte_array(img_path)
 
     # load labels
-    label_imgs = []
-    for shape in shapes:
-        lab = img_to_ubyte_array(
-            io.BytesIO(
-                shape_utils.shape_to_png(
-                    shape=shape, width=img.shape[1], height=img.shape[0], write_to=None
-                )
-            )
-        )
-        label_imgs.append(lab)
-
     shape_args = [
         {"width": img.shape[1], "height": img.shape[0], "shape": shape}
         for shape in shapes
     ]
     if (shape_layers is None) or (len(shape_layers) != len(shapes)):
         shape_layers = [(n + 1) for n, _ in enumerate(shapes)]
-    mask = shape_utils.shapes_to_mask(shape_args, shape_layers)
+    mask = shape_utils.shapes_to_mask(
+        shape_args,
+        shape_layers,
+        return_shape_masks=return_shape_masks,
+        cache=shape_mask_cache,
+    )
+    if return_shape_masks:
+        mask, shape_masks = mask
+    if checkpoint is not None:
+        checkpoint()
 
     # do segmentation and return this
-    seg, clf = trainable_segmentation(img, mask, **segmenter_args)
+    seg, clf = trainable_segmentation(
+        img,
+        mask,
+        feature_cache=feature_cache,
+        incremental_forest=incremental_forest,
+        feature_n_jobs=feature_n_jobs,
+        checkpoint=checkpoint,
+        resolution_level=resolution_level,
+        roi=roi,
+        cpu_budget=cpu_budget,
+        **segmenter_args
+    )
     color_seg = label_to_colors(seg, **label_to_colors_args)
     # color_seg is a 3d tensor representing a colored image whereas seg is a
     # matrix whose entries represent the classes
+    if return_shape_masks:
+        return (color_seg, seg, clf, shape_masks)
     return (color_seg, seg, clf)
 
 
-def blend_image_and_classified_regions(img, classr):
+def axis_ranges_to_roi(x_range, y_range, shape):
+    """
+    Region of interest (see compute_segmentations) of an image with the 2d
+    shape shown on axes with the ranges x_range and y_range (in either order,
+    e.g. the yaxis.range of an image, which is reversed), i.e. the pixels at
+    least partly in view. Returns None if the whole image, or none of it, is
+    in view.
+    """
+    c0, c1 = sorted(x_range)
+    r0, r1 = sorted(y_range)
+    roi = (
+        max(int(np.floor(r0)), 0),
+        min(int(np.ceil(r1)), shape[0]),
+        max(int(np.floor(c0)), 0),
+        min(int(np.ceil(c1)), shape[1]),
+    )
+    if roi == (0, shape[0], 0, shape[1]) or roi[0] >= roi[1] or roi[2] >= roi[3]:
+        return None
+    return roi
+
+
+def _div255_round(x):
+    """
+    In-place round(x / 255) of a uint16 array x with values in [0, 255 * 255],
+    using only shifts and adds.
+    """
+    x += 128
+    x += x >> 8
+    x >>= 8
+    return x
+
+
+def _blend_rows(img, classr, alpha, out):
+    """
+    Fixed-point blend of uint8 arrays img and classr (RGB) with alpha (either
+    an int or an array of the same rows), written to out.
+    """
+    acc = img.astype("uint16")
+    tmp = classr.astype("uint16")
+    if type(alpha) == type(int()):
+        acc *= 255 - alpha
+        tmp *= alpha
+    else:
+        alpha = alpha[:, :, None].astype("uint16")
+        tmp *= alpha
+        np.subtract(255, alpha, out=alpha)
+        acc *= alpha
+    acc += tmp
+    np.copyto(out, _div255_round(acc), casting="unsafe")
+
+
+def blend_image_and_classified_regions(img, classr, out=None, chunk_rows=256):
     """
     If img has an alpha channel, it is ignored.
     If classr has an alpha channel, the images are combined as
@@ -108,19 +229,31 @@ def blend_image_and_classified_regions(img, classr):
     Both images are converted to ubyte before blending and the alpha channel is
     divided by 255 to get the scalar.
     The returned image has no alpha channel.
+    The blend is computed in 16-bit fixed point, chunk_rows rows at a time,
+    which gives the same rounded result as the floating point formula above
+    without full-size temporaries. If out (a uint8 array the shape of img
+    without alpha channel) is given, the result is written to it.
     """
     img = skimage.img_as_ubyte(img)
     classr = skimage.img_as_ubyte(classr)
     img = img[:, :, :3]
     if classr.shape[2] < 4:
         return classr
-    alpha = (classr[:, :, 3] / 255)[:, :, None]
+    alpha = classr[:, :, 3]
     classr = classr[:, :, :3]
-    out_img = img * (1 - alpha) + classr * alpha
-    out_img = np.round(out_img)
-    out_img[out_img > 255] = 255
-    out_img[out_img < 0] = 0
-    return out_img.astype("uint8")
+    if out is None:
+        out = np.empty(img.shape, dtype="uint8")
+    a_min, a_max = alpha.min(), alpha.max()
+    for r in range(0, img.shape[0], chunk_rows):
+        rows = slice(r, r + chunk_rows)
+        # constant alpha, e.g., label_to_colors output, is a scalar multiply
+        _blend_rows(
+            img[rows],
+            classr[rows],
+            int(a_min) if a_min == a_max else alpha[rows],
+            out[rows],
+        )
+    return out
 
 
 def blend_image_and_classified_regions_pil(img, classr):
@@ -2,7 +2,7 @@ __doc__ = """
 Use the classifier that you downloaded from the ml_image_segmentation.py webapp.
 Specify files to use on the command line like so:
 
-    CLF_PATH=path/to/classifier.json \\
+    CLF_PATH=path/to/classifier.npz \\
     IMG_PATH=path/to/image/to/classify.some_image_ending \\
     OUT_IMG_PATH=path/to/where/to/put/classified/image.some_image_ending \\
     OUT_BLEND_PATH=path/to/where/to/put/classified/blended/with/original/image.some_image_ending \\
@@ -10,18 +10,59 @@ Specify files to use on the command line like so:
 
 some_image_ending can be a common image format's ending, e.g., png or jpg
 
+The classifier is evaluated from its .npz file, which is memory mapped, with
+the compiled trees of scikit-learn if it is installed or with numpy alone
+otherwise. Classifiers downloaded as classifier.json by older versions of
+the webapp (pickled scikit-learn forests) can only be used if their sigma
+range gives the same feature sigmas as in those versions, e.g. the default
+range of 0.5 to 16 (or any range between powers of 2); the others are
+rejected with an error, and must be trained again.
+
+To classify many images, set IMG_PATH to a directory (its images are
+classified) or to a glob pattern in quotes (e.g. IMG_PATH='frames/*.jpg'), and
+OUT_IMG_PATH and OUT_BLEND_PATH to the directories where to put the classified
+and blended images, which are PNG files named after the images. The images
+are classified by N_WORKERS processes (by default one per CPU), each loading
+the classifier once, while threads read the next images and write the
+outputs of the previous ones. Images whose outputs are newer than the image
+and the classifier are skipped, so an interrupted batch can be resumed.
+
+For large images, set TILE_SIZE (e.g., TILE_SIZE=512) to compute features and
+classify the image in tiles of that size, which bounds memory use.
+
+To classify only a region of the image, set ROI to its row_start, row_stop,
+col_start and col_stop (e.g., ROI=200,500,300,700). The outputs are then the
+size of the region.
+
 """
 
 import os
+import sys
+import glob
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 import plot_common
 import shapes_to_segmentations
-import pickle
 import image_segmentation
+import forest_utils
+from job_utils import Pipeline
 import base64
 import io
 import skimage.io
 import json
 
+# endings of the files of a directory IMG_PATH that are classified
+IMG_ENDINGS = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp")
+
+# threads of a batch reading the images and writing the outputs, which mostly
+# wait for the disk or run image codecs that release the GIL
+DECODE_THREADS = 2
+ENCODE_THREADS = 2
+
+# images of a batch waiting between two of its stages
+BATCH_QUEUE_SIZE = 2
+
+
 def getenv(e):
     try:
         return os.environ[e]
@@ -30,39 +71,300 @@ def getenv(e):
         raise
 
 
+def parse_roi(s):
+    """ Parses a "row_start,row_stop,col_start,col_stop" region of interest """
+    roi = tuple(int(b) for b in s.split(","))
+    if len(roi) != 4:
+        raise ValueError("ROI must be row_start,row_stop,col_start,col_stop")
+    return roi
+
+
+def save_img(img_array, path):
+    """
+    Saves the image array to path, in the format of its ending, through a
+    temporary file renamed to path, so that path never has a partial image
+    (which a batch would take for an up to date output).
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=".tmp-", suffix=os.path.splitext(name)[1], dir=directory
+    )
+    os.close(fd)
+    try:
+        plot_common.img_array_to_pil_image(img_array).save(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def classify_img(
+    clf, segmenter_args, label_to_colors_args, img, tile_size=None, roi=None
+):
+    """ Returns the classified image of the image array img (or of its roi) """
+    seg, clf = image_segmentation.trainable_segmentation(
+        img, clf=clf, tile_size=tile_size, roi=roi, **segmenter_args
+    )
+    return shapes_to_segmentations.label_to_colors(seg, **label_to_colors_args)
+
+
+def save_classified_img(img, color_seg, out_img, out_blend=None, roi=None):
+    """
+    Saves the classified image color_seg of the image array img (or of its
+    roi) to out_img and, if out_blend is given, img blended with it to
+    out_blend.
+    """
+    save_img(color_seg, out_img)
+    if out_blend is not None:
+        if roi is not None:
+            img = img[image_segmentation.roi_slices(roi, img.shape[:2])]
+        blend_img = shapes_to_segmentations.blend_image_and_classified_regions(
+            img, color_seg
+        )
+        save_img(blend_img, out_blend)
+
+
 def use_img_classifier_in_mem(
-    clf, segmenter_args, label_to_colors_args, img_path, out_img
+    clf,
+    segmenter_args,
+    label_to_colors_args,
+    img_path,
+    out_img,
+    tile_size=None,
+    roi=None,
+    out_blend=None,
 ):
+    """
+    Classifies the image img_path with clf and saves the classified image to
+    out_img and, if out_blend is given, the image blended with it to
+    out_blend, computed from the classified image in memory.
+    """
     img = skimage.io.imread(img_path)
-    seg, clf = image_segmentation.trainable_segmentation(img, clf=clf, **segmenter_args)
-    color_seg = shapes_to_segmentations.label_to_colors(seg, **label_to_colors_args)
-    segimgpil = plot_common.img_array_to_pil_image(color_seg)
-    segimgpil.save(out_img)
+    color_seg = classify_img(
+        clf, segmenter_args, label_to_colors_args, img, tile_size, roi
+    )
+    save_classified_img(img, color_seg, out_img, out_blend, roi)
 
 
-def use_img_classifier(clf_file, img_path, out_img):
+def load_classifier(clf_file):
     """
-    clf_file contains the classifier and other parameters (see below)
-    img contains the image we want to run the classifier on
+    Returns (clf, segmenter_args, label_to_colors_args) from clf_file, an .npz
+    file saved by forest_utils.save_forest or a classifier.json file with a
+    pickled classifier. Raises ValueError if the classifier was trained on
+    features at other sigmas than its segmenter_args give (see
+    image_segmentation.check_sigmas), which is the case of the classifier.json
+    files whose sigma range doesn't start and end at powers of 2.
     """
+    if clf_file.endswith(".npz"):
+        clf, metadata = forest_utils.load_forest(clf_file)
+        image_segmentation.check_sigmas(
+            metadata["segmenter_args"], metadata.get("sigmas")
+        )
+        return clf, metadata["segmenter_args"], metadata["label_to_colors_args"]
+    # unpickling needs scikit-learn
+    import pickle
+
     with open(clf_file, "rb") as fd:
         classr = json.load(fd)
-    clfb64 = classr["classifier"]
-    segmenter_args = classr["segmenter_args"]
-    label_to_colors_args = classr["label_to_colors_args"]
-    clf = pickle.load(io.BytesIO(base64.b64decode(clfb64)))
+    # classifier.json files were saved before the sigmas were
+    image_segmentation.check_sigmas(classr["segmenter_args"])
+    clf = pickle.load(io.BytesIO(base64.b64decode(classr["classifier"])))
+    return clf, classr["segmenter_args"], classr["label_to_colors_args"]
+
+
+def use_img_classifier(
+    clf_file, img_path, out_img, tile_size=None, roi=None, out_blend=None
+):
+    """
+    clf_file contains the classifier and other parameters (see
+    load_classifier)
+    img contains the image we want to run the classifier on
+    tile_size and roi are passed to image_segmentation.trainable_segmentation
+    out_blend is as in use_img_classifier_in_mem
+    """
+    clf, segmenter_args, label_to_colors_args = load_classifier(clf_file)
     use_img_classifier_in_mem(
-        clf, segmenter_args, label_to_colors_args, img_path=img_path, out_img=out_img
+        clf,
+        segmenter_args,
+        label_to_colors_args,
+        img_path=img_path,
+        out_img=out_img,
+        tile_size=tile_size,
+        roi=roi,
+        out_blend=out_blend,
     )
 
 
+def is_batch(img_path):
+    """Whether IMG_PATH img_path is a directory or glob pattern of images"""
+    return os.path.isdir(img_path) or glob.has_magic(img_path)
+
+
+def batch_jobs(clf_file, img_pattern, out_img_dir, out_blend_dir):
+    """
+    Returns (jobs, n_up_to_date) where jobs are the (img_path, out_img,
+    out_blend) of the images of img_pattern, a directory or a glob pattern,
+    whose outputs (PNG files of out_img_dir and out_blend_dir named after the
+    image) are missing or older than the image or clf_file, and n_up_to_date
+    the number of the other images.
+    """
+    if os.path.isdir(img_pattern):
+        img_paths = [
+            os.path.join(img_pattern, name)
+            for name in os.listdir(img_pattern)
+            if name.lower().endswith(IMG_ENDINGS)
+        ]
+    else:
+        img_paths = [p for p in glob.glob(img_pattern) if os.path.isfile(p)]
+    clf_mtime = os.stat(clf_file).st_mtime
+    jobs = []
+    n_up_to_date = 0
+    names = set()
+    for img_path in sorted(img_paths):
+        name = os.path.splitext(os.path.basename(img_path))[0] + ".png"
+        if name in names:
+            raise ValueError("Several images have the outputs %r" % (name,))
+        names.add(name)
+        outputs = (os.path.join(out_img_dir, name), os.path.join(out_blend_dir, name))
+        newer_than = max(os.stat(img_path).st_mtime, clf_mtime)
+        if all(
+            os.path.exists(p) and os.stat(p).st_mtime >= newer_than for p in outputs
+        ):
+            n_up_to_date += 1
+        else:
+            jobs.append((img_path,) + outputs)
+    return jobs, n_up_to_date
+
+
+# classifier of a worker process of use_img_classifier_batch, with its
+# segmenter_args and label_to_colors_args
+_worker_classifier = None
+
+
+def _load_worker_classifier(clf_file):
+    global _worker_classifier
+    _worker_classifier = load_classifier(clf_file)
+    clf = _worker_classifier[0]
+    # the workers already use all the cores
+    if hasattr(clf, "set_params"):
+        clf.set_params(n_jobs=1)
+
+
+def _classify_batch_img(img, tile_size=None, roi=None):
+    """classify_img with the classifier of the worker process"""
+    return classify_img(*_worker_classifier, img, tile_size, roi)
+
+
+def use_img_classifier_batch(
+    clf_file,
+    img_pattern,
+    out_img_dir,
+    out_blend_dir,
+    n_workers=None,
+    tile_size=None,
+    roi=None,
+):
+    """
+    Classifies the images of img_pattern (see batch_jobs) whose outputs are
+    not up to date, with n_workers processes (by default one per CPU) which
+    each load the classifier clf_file once. tile_size and roi are as in
+    use_img_classifier.
+    The images stream through a job_utils.Pipeline: DECODE_THREADS threads
+    read them, n_workers threads each pass one image at a time to the
+    processes and ENCODE_THREADS threads write the outputs, so that reading
+    and writing images overlap with classifying them.
+    Returns (n_classified, n_up_to_date, failed, stats), where failed is a
+    list of (img_path, error) of the images that couldn't be classified and
+    stats the metrics of the stages of the pipeline (see Pipeline.stats).
+    """
+    os.makedirs(out_img_dir, exist_ok=True)
+    os.makedirs(out_blend_dir, exist_ok=True)
+    jobs, n_up_to_date = batch_jobs(clf_file, img_pattern, out_img_dir, out_blend_dir)
+    n_workers = n_workers or os.cpu_count()
+    failed = []
+    with ProcessPoolExecutor(
+        n_workers,
+        initializer=_load_worker_classifier,
+        initargs=(clf_file,),
+    ) as pool:
+
+        def decode(job):
+            return job, skimage.io.imread(job[0])
+
+        def classify(decoded):
+            job, img = decoded
+            color_seg = pool.submit(_classify_batch_img, img, tile_size, roi).result()
+            return job, img, color_seg
+
+        def encode(classified):
+            (_, out_img, out_blend), img, color_seg = classified
+            save_classified_img(img, color_seg, out_img, out_blend, roi)
+
+        pipeline = Pipeline(
+            [
+                ("decode", decode, DECODE_THREADS),
+                ("classify", classify, n_workers),
+                ("encode", encode, ENCODE_THREADS),
+            ],
+            queue_size=BATCH_QUEUE_SIZE,
+        )
+        for (img_path, _, _), _, error in pipeline.run(jobs):
+            if error is not None:
+                error = "%s: %s" % (type(error).__name__, error)
+                print("%s: %s" % (img_path, error), file=sys.stderr)
+                failed.append((img_path, error))
+    return len(jobs) - len(failed), n_up_to_date, failed, pipeline.stats()
+
+
 if __name__ == "__main__":
     clf_path = getenv("CLF_PATH")
     img_path = getenv("IMG_PATH")
     out_img_path = getenv("OUT_IMG_PATH")
     blend_path = getenv("OUT_BLEND_PATH")
-    use_img_classifier(clf_path, img_path, out_img_path)
-    blend_img = shapes_to_segmentations.blend_image_and_classified_regions(
-        skimage.io.imread(img_path), skimage.io.imread(out_img_path)
-    )
-    skimage.io.imsave(blend_path,blend_img)
+    tile_size = os.environ.get("TILE_SIZE")
+    if tile_size is not None:
+        tile_size = int(tile_size)
+    roi = os.environ.get("ROI")
+    if roi is not None:
+        roi = parse_roi(roi)
+    if is_batch(img_path):
+        n_workers = os.environ.get("N_WORKERS")
+        if n_workers is not None:
+            n_workers = int(n_workers)
+        n_classified, n_up_to_date, failed, stats = use_img_classifier_batch(
+            clf_path,
+            img_path,
+            out_img_path,
+            blend_path,
+            n_workers=n_workers,
+            tile_size=tile_size,
+            roi=roi,
+        )
+        print(
+            "classified %d images, %d up to date, %d failed"
+            % (n_classified, n_up_to_date, len(failed))
+        )
+        for name, st in stats.items():
+            print(
+                "%s: %d threads, %.2f images/s, busy %.2f s, waiting for images "
+                "%.2f s, blocked by the next stage %.2f s"
+                % (
+                    name,
+                    st["n_threads"],
+                    st["items_per_second"],
+                    st["busy_time"],
+                    st["starved_time"],
+                    st["blocked_time"],
+                )
+            )
+        if len(failed) > 0:
+            sys.exit(1)
+    else:
+        use_img_classifier(
+            clf_path,
+            img_path,
+            out_img_path,
+            tile_size=tile_size,
+            roi=roi,
+            out_blend=blend_path,
+        )